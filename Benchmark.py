@@ -0,0 +1,247 @@
+import argparse
+import contextlib
+import itertools
+import json
+import multiprocessing as mp
+import os
+import queue
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from Configuration import Config
+from simple_key_value_store.Client import Client as FS_client
+
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def peak_memory_mb(pid=None):
+    # VmHWM of a running process, or the peak of this one
+    if pid is not None:
+        try:
+            with open('/proc/' + str(pid) + '/status') as status:
+                for line in status:
+                    if line.startswith('VmHWM:'):
+                        return round(int(line.split()[1]) / 1024, 1)
+        except OSError:
+            return None
+        return None
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    if verbose:
+        yield
+        return
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def run_store(port, storage, work_dir, verbose):
+    from simple_key_value_store.Server import Server
+    os.chdir(work_dir)
+    with quiet(verbose):
+        server = Server(('127.0.0.1', port), storage=storage)
+        server.run()
+
+
+def run_worker(name, cfg, master_port, store_port, memory, verbose):
+    from Worker import Worker
+    with quiet(verbose):
+        worker = Worker(('127.0.0.1', master_port), cfg.mapper_count, cfg.reducer_count, cfg.output_data,
+                        cfg.combine_fn, cfg.combiner_size, cfg.buffer_bytes, cfg.buffer_records,
+                        cfg.sort_buffer_bytes, cfg.partitioner, cfg.shuffle_fetchers, cfg.heartbeat_interval,
+                        cfg.map_chunk_bytes, cfg.compression_level)
+        worker.serve(name, cfg.map_fn, cfg.reduce_fn, ('127.0.0.1', store_port), poll_interval=0.2)
+    memory.put((name, peak_memory_mb()))
+
+
+class LocalCluster:
+    # Stands in for CloudInterface: the store runs at 127.0.0.1 and every
+    # worker "VM" is a local process
+    def __init__(self, cfg, master_port, store_port, verbose=False):
+        self.cfg = cfg
+        self.master_port = master_port
+        self.store_port = store_port
+        self.verbose = verbose
+        self.instances = {}
+        self.memory = mp.Queue()
+
+    def get_ip_from_name(self, name, NAT=False):
+        return '127.0.0.1'
+
+    def update_instances(self, force=False):
+        self.instances = {name: process for name, process in self.instances.items() if process.is_alive()}
+
+    def create_instances(self, names, init_script=None, preemptible=False):
+        for name in names:
+            process = mp.Process(target=run_worker, args=(name, self.cfg, self.master_port, self.store_port,
+                                                          self.memory, self.verbose))
+            process.start()
+            self.instances[name] = process
+
+    def delete_instances(self, names):
+        for name in names:
+            process = self.instances.pop(name, None)
+            if process is None:
+                continue
+            process.join(5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+    def worker_memory(self):
+        peaks = {}
+        while not self.memory.empty():
+            name, peak = self.memory.get()
+            peaks[name] = peak
+        return peaks
+
+
+def upload(port, path, replicas):
+    with open(path, 'rb') as f:
+        corpus = f.read()
+    client = FS_client(('127.0.0.1', port))
+    client.connect()
+    client.set('bench_input', corpus * replicas)
+    client.close()
+
+
+def wait_for_store(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            with socket.create_connection(('127.0.0.1', port), 1):
+                return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.05)
+
+
+def run_job(job, results, verbose=False):
+    # Runs one job on a fresh local store, master and worker processes, and
+    # puts its measurements on results
+    from Master import Master
+    cfg = Config(job['config'], job['mode'])
+    cfg.parse()
+    cfg.mapper_count = job['n_mappers']
+    cfg.reducer_count = job['n_reducers']
+    cfg.compression_level = job['compression_level']
+    cfg.output_data = 'bench_output'
+    work_dir = tempfile.mkdtemp(prefix='benchmark_')
+    store_port = free_port()
+    master_port = free_port()
+    store = mp.Process(target=run_store, args=(store_port, job['storage'], work_dir, verbose), daemon=True)
+    store.start()
+    try:
+        wait_for_store(store_port)
+        # Uploaded from another process so the input does not count
+        # towards the master's memory
+        uploader = mp.Process(target=upload, args=(store_port, cfg.input_data, job['replicas']))
+        uploader.start()
+        uploader.join()
+
+        cluster = LocalCluster(cfg, master_port, store_port, verbose)
+        master = Master(cluster, ('127.0.0.1', master_port), [], cfg.mapper_count, cfg.reducer_count,
+                        cfg.map_fn, cfg.reduce_fn, 'bench_input', cfg.output_data,
+                        partitioner=cfg.partitioner, partition_sample_bytes=cfg.partition_sample_bytes,
+                        n_workers=job['n_workers'], lease_timeout=cfg.lease_timeout,
+                        speculation=cfg.speculation, speculation_threshold=cfg.speculation_threshold,
+                        reduce_slowstart=cfg.reduce_slowstart, store_port=store_port)
+        with quiet(verbose):
+            try:
+                master.run()
+            except SystemExit:
+                pass
+        summary = master.job_counters()
+        counters = summary['counters']
+        seconds = summary['seconds']
+        total = max(seconds.get('total', 0), 1e-6)
+        input_bytes = os.path.getsize(cfg.input_data) * job['replicas']
+        workers = cluster.worker_memory()
+        results.put(dict(job, **{
+            'input_bytes': input_bytes,
+            'records': counters['map'].get('map_output_records', 0),
+            'output_records': counters['reduce'].get('output_records', 0),
+            'records_per_second': round(counters['map'].get('map_output_records', 0) / total, 1),
+            'mb_per_second': round(input_bytes / total / 1e6, 3),
+            'seconds': seconds,
+            'peak_memory_mb': {
+                'master': peak_memory_mb(),
+                'store': peak_memory_mb(store.pid),
+                'worker_max': max(workers.values(), default=None),
+            },
+            'counters': counters,
+        }))
+    except Exception as e:
+        results.put(dict(job, error=repr(e)))
+    finally:
+        store.terminate()
+        store.join()
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def benchmark(modes, replicas, mappers, reducers, storages, workers=None, compression_levels=(0,),
+              config='config.json', verbose=False):
+    # Every combination runs as its own job, in a fresh process so peak
+    # memory is measured per job
+    runs = []
+    for mode, n, m, r, storage, level in itertools.product(modes, replicas, mappers, reducers, storages,
+                                                            compression_levels):
+        job = {
+            'config': config,
+            'mode': mode,
+            'replicas': n,
+            'n_mappers': m,
+            'n_reducers': r,
+            'n_workers': workers,
+            'storage': storage,
+            'compression_level': level,
+        }
+        results = mp.Queue()
+        process = mp.Process(target=run_job, args=(job, results, verbose))
+        process.start()
+        result = None
+        while result is None:
+            try:
+                result = results.get(timeout=1)
+            except queue.Empty:
+                if not process.is_alive():
+                    result = dict(job, error='job process exited with code ' + str(process.exitcode))
+        process.join()
+        print(mode, 'x' + str(n), str(m) + 'm', str(r) + 'r', storage, 'level', level, '->',
+              result.get('error') or str(result['seconds']['total']) + ' s', file=sys.stderr)
+        runs.append(result)
+    return {'python': sys.version.split()[0], 'cpus': mp.cpu_count(), 'runs': runs}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Runs MapReduce jobs on a local store and worker processes')
+    parser.add_argument('--modes', nargs='+', default=['word_count', 'inverted_index'])
+    parser.add_argument('--replicas', nargs='+', type=int, default=[1, 4], help='copies of the input corpus')
+    parser.add_argument('--mappers', nargs='+', type=int, default=[4])
+    parser.add_argument('--reducers', nargs='+', type=int, default=[2])
+    parser.add_argument('--storage', nargs='+', choices=['file', 'log'], default=['file'])
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per task)')
+    parser.add_argument('--compression', nargs='+', type=int, default=[0], help='compression levels')
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--output', default=None, help='also write the JSON report to this file')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the store, master and workers')
+    args = parser.parse_args()
+
+    report = benchmark(args.modes, args.replicas, args.mappers, args.reducers, args.storage, args.workers,
+                       args.compression, args.config, args.verbose)
+    report = json.dumps(report, indent=4)
+    if args.output is not None:
+        with open(args.output, 'w') as out:
+            out.write(report)
+    print(report)
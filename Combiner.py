@@ -0,0 +1,38 @@
+import time
+
+
+class Combiner:
+    def __init__(self, combine_fn, emit_batch, max_entries=10000, max_values=64):
+        self.combine_fn = combine_fn
+        self.emit_batch = emit_batch
+        self.max_entries = max_entries
+        self.max_values = max_values
+        self.table = {}
+        self.records_in = 0
+        self.records_out = 0
+        # Time spent in combine_fn
+        self.seconds = 0
+
+    def add(self, key, value):
+        self.records_in += 1
+        values = self.table.get(key)
+        if values is None:
+            if len(self.table) >= self.max_entries:
+                self.flush()
+            self.table[key] = [value]
+            return
+        values.append(value)
+        # Keep hot keys from growing without bound between flushes
+        if len(values) >= self.max_values:
+            start = time.perf_counter()
+            self.table[key] = [self.combine_fn(key, values)]
+            self.seconds += time.perf_counter() - start
+
+    def flush(self):
+        combine_fn = self.combine_fn
+        start = time.perf_counter()
+        pairs = [(key, combine_fn(key, values)) for key, values in self.table.items()]
+        self.seconds += time.perf_counter() - start
+        self.records_out += len(pairs)
+        self.table = {}
+        self.emit_batch(pairs)
@@ -5,6 +5,9 @@ class Config:
     def __init__(self, file, mode="default"):
         self.file = open(file, 'r')
         self.config = json.loads(self.file.read())
+        # Settings a job section leaves out may come from the default one
+        self.defaults = self.config.get('default', {})
+        self.mode = mode
         self.config = self.config[mode]
 
     def get_network_config(self,config):
@@ -22,13 +25,47 @@ class Config:
         method = getattr(module, 'reduce_fn')
         return method
 
+    def get_combine_method(self, location):
+        if location is None:
+            return None
+        module = importlib.import_module(location)
+        method = getattr(module, 'combine_fn')
+        return method
+
     def parse(self):
-        self.project = self.config['project']
-        self.zone = self.config['zone']
+        self.project = self.config.get('project', self.defaults.get('project'))
+        self.zone = self.config.get('zone', self.defaults.get('zone'))
+        self.operation_rate = self.config.get('operation_rate', 5)
+        self.operation_burst = self.config.get('operation_burst', 10)
         self.network_config = self.get_network_config(self.config['network_config'])
         self.input_data = self.config['input_data']
         self.mapper_count = self.config['n_mappers']
         self.reducer_count = self.config['n_reducers']
+        self.worker_count = self.config.get('n_workers')
         self.output_data = self.config['output_data']
         self.map_fn = self.get_map_method(self.config['map_fn'])
         self.reduce_fn = self.get_reduce_method(self.config['reduce_fn'])
+        self.combine_fn = self.get_combine_method(self.config.get('combine_fn'))
+        self.combiner_size = self.config.get('combiner_size', 10000)
+        self.buffer_bytes = self.config.get('buffer_bytes', 65536)
+        self.buffer_records = self.config.get('buffer_records', 1000)
+        self.sort_buffer_bytes = self.config.get('sort_buffer_bytes', 32 * 1024 * 1024)
+        self.shuffle_fetchers = self.config.get('shuffle_fetchers', 4)
+        self.heartbeat_interval = self.config.get('heartbeat_interval', 2)
+        self.lease_timeout = self.config.get('lease_timeout', 10)
+        self.map_chunk_bytes = self.config.get('map_chunk_bytes', 1024 * 1024)
+        self.compression_level = self.config.get('compression_level', 0)
+        self.speculation = self.config.get('speculation', True)
+        self.speculation_threshold = self.config.get('speculation_threshold', 0.5)
+        self.reduce_slowstart = self.config.get('reduce_slowstart', 0.6)
+        self.trace_file = self.config.get('trace_file')
+        self.partitioner = self.config.get('partitioner', 'hash')
+        self.partition_sample_bytes = self.config.get('partition_sample_bytes', 65536)
+        self.local_processes = self.config.get('local_processes')
+
+    def check_cloud(self):
+        # Runs on GCP need a project and a zone, which local runs do without
+        missing = [name for name in ('project', 'zone') if getattr(self, name) is None]
+        if len(missing) > 0:
+            raise ValueError(self.file.name + ': no ' + ' or '.join(missing) + ' in section "' + self.mode +
+                             '" or in "default", which a cloud run needs')
@@ -0,0 +1,149 @@
+import itertools
+import threading
+import time
+
+
+class RateExceeded(Exception):
+    pass
+
+
+class Request:
+    def __init__(self, compute, name, fn):
+        self.compute = compute
+        self.name = name
+        self.fn = fn
+
+    def execute(self):
+        time.sleep(self.compute.call_latency)
+        with self.compute.lock:
+            self.compute.calls[self.name] = self.compute.calls.get(self.name, 0) + 1
+            return self.fn()
+
+
+class Instances:
+    def __init__(self, compute):
+        self.compute = compute
+
+    def insert(self, project, zone, body, sourceMachineImage=None):
+        compute = self.compute
+
+        def fn():
+            operation = compute.operation('insert', body['name'])
+            n = len(compute.vms) % 250 + 2
+            compute.vms[body['name']] = {
+                'name': body['name'],
+                'status': 'RUNNING',
+                'networkInterfaces': [{
+                    'networkIP': '10.128.0.%d' % n,
+                    'accessConfigs': [{'natIP': '34.0.0.%d' % n}],
+                }],
+            }
+            return operation
+        return Request(compute, 'instances.insert', fn)
+
+    def delete(self, project, zone, instance):
+        compute = self.compute
+
+        def fn():
+            operation = compute.operation('delete', instance)
+            compute.vms.pop(instance, None)
+            return operation
+        return Request(compute, 'instances.delete', fn)
+
+    def list(self, project, zone):
+        compute = self.compute
+        return Request(compute, 'instances.list', lambda: {'items': list(compute.vms.values())} if compute.vms else {})
+
+
+class ZoneOperations:
+    def __init__(self, compute):
+        self.compute = compute
+
+    def get(self, project, zone, operation):
+        compute = self.compute
+
+        def fn():
+            done = time.time() >= compute.operations[operation]
+            return {'name': operation, 'status': 'DONE' if done else 'RUNNING'}
+        return Request(compute, 'zoneOperations.get', fn)
+
+
+class MachineImages:
+    def __init__(self, compute):
+        self.compute = compute
+
+    def get(self, project, machineImage):
+        return Request(self.compute, 'machineImages.get', lambda: {'selfLink': 'global/machineImages/' + machineImage})
+
+
+class FakeCompute:
+    # Stands in for googleapiclient.discovery.build('compute', 'beta') so
+    # CloudInterface can be used without a project. Every call takes
+    # call_latency seconds, operations finish operation_latency seconds after
+    # they were issued, and more than max_operations_per_second inserts and
+    # deletes within a second fail like RESOURCE_OPERATION_RATE_EXCEEDED.
+    def __init__(self, call_latency=0.05, operation_latency=2.0, max_operations_per_second=None):
+        self.call_latency = call_latency
+        self.operation_latency = operation_latency
+        self.max_operations_per_second = max_operations_per_second
+        self.vms = {}
+        self.operations = {}
+        self.issued = []
+        self.calls = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+
+    def operation(self, kind, target):
+        now = time.time()
+        if self.max_operations_per_second is not None:
+            self.issued = [t for t in self.issued if now - t < 1]
+            if len(self.issued) >= self.max_operations_per_second:
+                raise RateExceeded('RESOURCE_OPERATION_RATE_EXCEEDED: ' + kind + ' ' + target)
+            self.issued.append(now)
+        name = 'operation-%d' % next(self.ids)
+        self.operations[name] = now + self.operation_latency
+        return {'name': name, 'status': 'RUNNING'}
+
+    def instances(self):
+        return Instances(self)
+
+    def zoneOperations(self):
+        return ZoneOperations(self)
+
+    def machineImages(self):
+        return MachineImages(self)
+
+
+def benchmark(n=50, operation_latency=2.0, max_operations_per_second=10):
+    # Provisions and deletes n workers against the fake, one by one and as
+    # a batch
+    from GCP import CloudInterface
+    results = {'workers': n}
+
+    def run(name, fn):
+        compute = FakeCompute(operation_latency=operation_latency, max_operations_per_second=max_operations_per_second)
+        gcp = CloudInterface('fake-project', 'fake-zone', compute=compute,
+                             operation_rate=max_operations_per_second, operation_burst=max_operations_per_second)
+        start = time.time()
+        fn(gcp, ['worker' + str(i) for i in range(n)])
+        results[name] = {'seconds': round(time.time() - start, 2), 'api_calls': sum(compute.calls.values())}
+
+    def one_by_one(gcp, names):
+        for name in names:
+            gcp.wait_for_operation(gcp.create_instance(name, init_script='worker.sh', preemptible=True)['name'])
+        for name in names:
+            gcp.wait_for_operation(gcp.delete_instance(name)['name'])
+
+    def batch(gcp, names):
+        gcp.create_instances(names, init_script='worker.sh', preemptible=True)
+        gcp.delete_instances(names)
+
+    run('one_by_one', one_by_one)
+    run('batch', batch)
+    return results
+
+
+if __name__ == '__main__':
+    import json
+    import sys
+    print(json.dumps(benchmark(*[int(arg) for arg in sys.argv[1:2]]), indent=4))
@@ -3,19 +3,73 @@
 
 import argparse
 import os
+import threading
 import time
 import sys
 import pprint
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TokenBucket:
+    # Hands out `rate` tokens per second on average and at most `capacity`
+    # at once
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def rate_exceeded(error):
+    message = str(error)
+    return 'RATE_EXCEEDED' in message or 'rateLimitExceeded' in message
 
-import googleapiclient.discovery
-from six.moves import input
 
 class CloudInterface:
-    def __init__(self, project, zone):
-        self.compute = googleapiclient.discovery.build('compute', 'beta')
+    # compute can be passed in, e.g. a FakeCompute for offline runs.
+    # Instance operations are started at most operation_rate per second
+    # with bursts of operation_burst. The instance list is cached for
+    # instance_ttl seconds and dropped whenever our own operations finish.
+    def __init__(self, project, zone, compute=None, operation_rate=5, operation_burst=10, concurrency=16,
+                 instance_ttl=30):
+        self.shared_compute = compute
+        self.local = threading.local()
         self.project = project
         self.zone = zone
         self.instances = {}
+        self.instance_ttl = instance_ttl
+        self.instances_updated = None
+        self.image_links = {}
+        self.startup_scripts = {}
+        self.memo_lock = threading.Lock()
+        self.bucket = TokenBucket(operation_rate, operation_burst)
+        self.concurrency = concurrency
+
+    @property
+    def compute(self):
+        # googleapiclient clients are not thread safe, so every thread that
+        # talks to the API builds its own
+        if self.shared_compute is not None:
+            return self.shared_compute
+        compute = getattr(self.local, 'compute', None)
+        if compute is None:
+            import googleapiclient.discovery
+            compute = googleapiclient.discovery.build('compute', 'beta')
+            self.local.compute = compute
+        return compute
 
     def list_instances(self):
         result = self.compute.instances().list(project=self.project, zone=self.zone).execute()
@@ -28,6 +82,9 @@ class CloudInterface:
 
     def get_ip_from_name(self, name, NAT=False):
         self.update_instances()
+        if name not in self.instances:
+            # Maybe created by someone else since the list was cached
+            self.update_instances(force=True)
         try:
             if NAT:
                 return self.instances[name]['networkInterfaces'][0]['accessConfigs'][0]['natIP']
@@ -42,19 +99,43 @@ class CloudInterface:
         result = self.compute.machineImages().list(project=self.project).execute()
         return result['items'] if 'items' in result else None
 
-    def update_instances(self):
+    def update_instances(self, force=False):
+        if not force and self.instances_updated is not None and time.time() - self.instances_updated < self.instance_ttl:
+            return
         result = self.list_instances()
+        instances = {}
         if result is not None:
             for instance in result:
-                self.instances[instance['name']] = instance
+                instances[instance['name']] = instance
+        self.instances = instances
+        self.instances_updated = time.time()
+
+    def invalidate_instances(self):
+        self.instances_updated = None
+
+    def image_link(self, base_image):
+        with self.memo_lock:
+            link = self.image_links.get(base_image)
+            if link is None:
+                image_response = self.compute.machineImages().get(project=self.project, machineImage=base_image).execute()
+                link = image_response['selfLink']
+                self.image_links[base_image] = link
+            return link
+
+    def startup_script(self, init_script):
+        with self.memo_lock:
+            script = self.startup_scripts.get(init_script)
+            if script is None:
+                script = open(os.path.join(os.getcwd(), 'scripts', init_script), 'r').read()
+                self.startup_scripts[init_script] = script
+            return script
 
 
     def create_instance(self, name, base_image="master-image", preemptible=False, init_script="master.sh"):
-        image_response = self.compute.machineImages().get(project=self.project, machineImage=base_image).execute()
-        source_disk_image = image_response['selfLink']
+        source_disk_image = self.image_link(base_image)
         # Configure the machine
         machine_type = "zones/%s/machineTypes/e2-micro" % self.zone
-        startup_script = open(os.path.join(os.getcwd(), 'scripts', init_script), 'r').read()
+        startup_script = self.startup_script(init_script)
         image_url = "http://storage.googleapis.com/gce-demo-input/photo.jpg"
         image_caption = "Ready for dessert?"
 
@@ -93,6 +174,7 @@ class CloudInterface:
         print("Creating Instance with config:")
         pprint.pprint(config, indent=4)
 
+        self.invalidate_instances()
         return self.compute.instances().insert(
             project=self.project,
             zone=self.zone,
@@ -107,27 +189,71 @@ class CloudInterface:
 
 
     def delete_instance(self, name):
+        self.invalidate_instances()
         return self.compute.instances().delete(
             project=self.project,
             zone=self.zone,
             instance=name).execute()
 
 
-    def wait_for_operation(self, operation):
-        print('Waiting for operation to finish...')
-        while True:
-            result = self.compute.zoneOperations().get(
-                project=self.project,
-                zone=self.zone,
-                operation=operation).execute()
-
-            if result['status'] == 'DONE':
-                print("done.")
-                if 'error' in result:
-                    raise Exception(result['error'])
-                return result
+    def start_operations(self, start, names):
+        # start(name) issues one operation. Operations are issued from a
+        # thread pool under the token bucket, and retried with backoff when
+        # the API still reports RESOURCE_OPERATION_RATE_EXCEEDED.
+        def issue(name):
+            delay = 1
+            while True:
+                self.bucket.acquire()
+                try:
+                    return start(name)
+                except Exception as e:
+                    if not rate_exceeded(e):
+                        raise
+                    print('Operation rate exceeded for', name + ', retrying in', delay, 's')
+                    time.sleep(delay)
+                    delay = min(delay * 2, 32)
+
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            return [operation['name'] for operation in executor.map(issue, names)]
+
+    def create_instances(self, names, base_image="master-image", preemptible=False, init_script="master.sh"):
+        start = lambda name: self.create_instance(name, base_image, preemptible, init_script)
+        return self.wait_for_operations(self.start_operations(start, names))
+
+    def delete_instances(self, names):
+        return self.wait_for_operations(self.start_operations(self.delete_instance, names))
+
+    def get_operation(self, operation):
+        return self.compute.zoneOperations().get(
+            project=self.project,
+            zone=self.zone,
+            operation=operation).execute()
+
+    def wait_for_operations(self, operations, delay=0.5, max_delay=8):
+        # All pending operations are polled together each round, and the
+        # pause between rounds doubles up to max_delay
+        print('Waiting for', len(operations), 'operations to finish...')
+        results = {}
+        pending = list(operations)
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            while len(pending) > 0:
+                for operation, result in zip(pending, executor.map(self.get_operation, pending)):
+                    if result['status'] == 'DONE':
+                        results[operation] = result
+                pending = [operation for operation in pending if operation not in results]
+                if len(pending) > 0:
+                    time.sleep(delay)
+                    delay = min(delay * 2, max_delay)
+        print("done.")
+        # Instances we created or deleted make the cached list stale
+        self.invalidate_instances()
+        errors = [results[operation]['error'] for operation in operations if 'error' in results[operation]]
+        if len(errors) > 0:
+            raise Exception(errors)
+        return [results[operation] for operation in operations]
 
-            time.sleep(1)
+    def wait_for_operation(self, operation):
+        return self.wait_for_operations([operation])[0]
 
 
 def main(project, zone, wait=True):
@@ -159,6 +285,7 @@ def main(project, zone, wait=True):
     print("Instances created.")
 
     if wait:
+        from six.moves import input
         input()
 
     print('Deleting instance.')
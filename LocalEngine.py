@@ -0,0 +1,138 @@
+import multiprocessing as mp
+import os
+import shutil
+import tempfile
+import time
+
+from Combiner import Combiner
+from Shuffle import ExternalSorter, grouped_reducer
+from Partitioner import create_partitioner, sample_boundaries
+from utils import parse_record, split_offsets
+
+
+def intermediate_path(work_dir, map_id, reduce_id):
+    return os.path.join(work_dir, 'intermediate_' + str(map_id) + '_' + str(reduce_id))
+
+
+def run_map_task(job, task_id, split):
+    path, start, end = split
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start).decode('utf-8')
+
+    partitions = [[] for _ in range(job['n_reducers'])]
+    partitioner = create_partitioner(job['partitioner'], job['n_reducers'], job['boundaries'])
+
+    def emit_intermediate_batch(pairs):
+        keys = [str(k) for k, v in pairs]
+        for p, k, (_, v) in zip(partitioner.partition_batch(keys), keys, pairs):
+            partitions[p].append(k + ':' + str(v) + '\n')
+
+    processed_data = job['map_fn'](job['input_data'], data)
+    if job['combine_fn'] is None:
+        emit_intermediate_batch(processed_data)
+    else:
+        combiner = Combiner(job['combine_fn'], emit_intermediate_batch, job['combiner_size'])
+        for k, v in processed_data:
+            combiner.add(k, v)
+        combiner.flush()
+
+    # Pieces are written under a name private to this process and renamed
+    # into place, so a reducer never sees a partly written piece.
+    for reduce_id, records in enumerate(partitions):
+        path = intermediate_path(job['work_dir'], task_id, reduce_id)
+        with open(path + '.' + str(os.getpid()), 'w') as out:
+            out.write(''.join(records))
+        os.replace(path + '.' + str(os.getpid()), path)
+    return task_id
+
+
+def run_reduce_task(job, task_id):
+    sorter = ExternalSorter(job['sort_buffer_bytes'], job['work_dir'])
+    out_path = os.path.join(job['work_dir'], 'output_' + str(task_id))
+    try:
+        for map_id in range(job['n_mappers']):
+            path = intermediate_path(job['work_dir'], map_id, task_id)
+            if os.path.exists(path):
+                with open(path, 'r') as f:
+                    for line in f:
+                        record = parse_record(line.rstrip('\n'))
+                        if record is not None:
+                            sorter.add(*record)
+        reduce = grouped_reducer(job['reduce_fn'])
+        with open(out_path, 'w') as out:
+            for key, values in sorter.groups():
+                for k, v in reduce(key, values):
+                    out.write(str(k) + ':' + str(v) + '\n')
+    finally:
+        sorter.close()
+    return out_path
+
+
+class LocalEngine:
+    def __init__(self, cfg, n_processes=None, work_dir=None):
+        self.cfg = cfg
+        self.n_processes = n_processes or cfg.local_processes or mp.cpu_count()
+        # Every process gets at least one map and one reduce task, however
+        # few the job asks for
+        self.n_mappers = max(cfg.mapper_count, self.n_processes)
+        self.n_reducers = max(cfg.reducer_count, self.n_processes)
+        self.work_dir = work_dir
+        self.keep_work_dir = work_dir is not None
+
+    def input_partition(self, path, n):
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            def read_window(offset, length):
+                f.seek(offset)
+                return f.read(length)
+            return [(path, start, end) for start, end in split_offsets(size, n, read_window)]
+
+    def sample_boundaries(self, splits):
+        samples = []
+        for path, start, end in splits:
+            with open(path, 'rb') as f:
+                f.seek(start)
+                data = f.read(min(end - start, self.cfg.partition_sample_bytes))
+            samples.append((path, data.decode('utf-8', errors='ignore')))
+        return sample_boundaries(self.cfg.map_fn, samples, self.n_reducers)
+
+    def run(self):
+        if self.work_dir is None:
+            self.work_dir = tempfile.mkdtemp(prefix='mapreduce_')
+        else:
+            os.makedirs(self.work_dir, exist_ok=True)
+        job = {
+            'input_data': self.cfg.input_data,
+            'n_mappers': self.n_mappers,
+            'n_reducers': self.n_reducers,
+            'map_fn': self.cfg.map_fn,
+            'reduce_fn': self.cfg.reduce_fn,
+            'combine_fn': self.cfg.combine_fn,
+            'combiner_size': self.cfg.combiner_size,
+            'sort_buffer_bytes': self.cfg.sort_buffer_bytes,
+            'partitioner': self.cfg.partitioner,
+            'boundaries': None,
+            'work_dir': self.work_dir,
+        }
+        start = time.time()
+        try:
+            splits = self.input_partition(self.cfg.input_data, self.n_mappers)
+            if self.cfg.partitioner == 'range':
+                job['boundaries'] = self.sample_boundaries(splits)
+            print('Running', len(splits), 'map tasks and', self.n_reducers, 'reduce tasks on', self.n_processes, 'processes')
+            with mp.Pool(self.n_processes) as pool:
+                pool.starmap(run_map_task, [(job, task_id, split) for task_id, split in enumerate(splits)])
+                print('Map phase complete')
+                outputs = pool.starmap(run_reduce_task, [(job, task_id) for task_id in range(self.n_reducers)])
+                print('Reduce phase complete')
+            with open(self.cfg.output_data, 'w') as out:
+                for path in outputs:
+                    with open(path, 'r') as f:
+                        shutil.copyfileobj(f, out)
+        finally:
+            if not self.keep_work_dir:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+                self.work_dir = None
+        print('Output written to', self.cfg.output_data, 'in', round(time.time() - start, 2), 'seconds')
+        return self.cfg.output_data
@@ -1,82 +1,33 @@
 from rpc.Server import Server
-import multiprocessing as mp
 import time
 import os
+import json
 from simple_key_value_store.Client import Client as FS_client
-from Worker import Worker
-import importlib
-from utils import clear_store
+from utils import split_offsets, intermediate_key, commit_key, output_key
+from Partitioner import sample_boundaries
 import threading
 import sys
+from contextlib import contextmanager
 
 from GCP import CloudInterface
 from Configuration import Config
-
-class ProcessFactoryElement:
-    def __init__(self, process_id, process):
-        self.timestamp = time.time()
-        self.process = process
-        self.process_id = process_id
-        self.max_wait_time = 5
-        self.status = "initialized"
-
-    def is_complete(self):
-        return self.status == "completed"
-
-    def start(self):
-        self.process.start()
-        self.status = "running"
-    
-    def stop(self):
-        self.status = "completed"
-        self.process.join(1)
-        while self.process.is_alive():
-            self.process.terminate()
-            self.process.close()
-
-
-class ProcessFactory:
-    def __init__(self):
-        self.processes = {}
-
-    def get_pid(self, task_type, task_id):
-        pid = str(task_type) + str(task_id)
-        return pid
-
-    def create_process(self, task_type, task_id, worker):
-        pid = self.get_pid(task_type, task_id)
-        self.processes[pid] = ProcessFactoryElement(pid, mp.Process(target=worker.run))
-    
-    def start_process(self, task_type, task_id):
-        pid = self.get_pid(task_type, task_id)
-        self.processes[pid].start()
-
-    def end_process(self, task_type, task_id):
-        pid = self.get_pid(task_type, task_id)
-        t = threading.Thread(target=self.processes[pid].stop())
-        t.start()
-
-    def check_process_completion_by_type(self, task_type):
-        if len(self.processes) > 0:
-            for key in self.processes:
-                if task_type in key:
-                    if not self.processes[key].is_complete():
-                        return False
-        else:
-            print('No process has been started as of now.')
-        return True
-
-    def print_status(self):
-        for key in self.processes:
-            process = self.processes[key]
-            print(key, process.status)
+from LocalEngine import LocalEngine
+from Scheduler import TaskTable
+from Trace import Tracer, chrome_trace
 
 class Master:
-    def __init__(self, gcp, networkConfig, methods, n_mappers, n_reducers, map_fn, reduce_fn, input_data, output_data):
+    def __init__(self, gcp, networkConfig, methods, n_mappers, n_reducers, map_fn, reduce_fn, input_data, output_data,
+                 partitioner='hash', partition_sample_bytes=65536, n_workers=None, lease_timeout=10,
+                 speculation=True, speculation_threshold=0.5, reduce_slowstart=0.6, trace_file=None, store_port=80):
         self.gcp = gcp
-        self.server = Server(networkConfig, [self.signal_complete, self.heartbeat, self.fault, *methods])
+        self.server = Server(networkConfig, [self.signal_complete, self.heartbeat, self.fault, self.request_task,
+                                             self.task_status, self.job_counters, self.job_trace, *methods])
         self.n_mappers = n_mappers
         self.n_reducers = n_reducers
+        self.n_workers = n_workers
+        self.workers = []
+        self.pool_target = 0
+        self.retired = set()
 
         self.input_data = input_data
         self.output_data = output_data
@@ -86,14 +37,107 @@ class Master:
         self.networkConfig = networkConfig
         self.base_dir = os.getcwd()
         self.fs_client = None
+        self.store_port = store_port
         self.file_dict = {}
-        self.mappers = {}
-        self.reducers = {}
         self.splits = {}
-        self.factory = ProcessFactory()
+        self.speculation = speculation
+        self.speculation_threshold = speculation_threshold
+        self.reduce_slowstart = reduce_slowstart
+        self.tasks = TaskTable(n_mappers, n_reducers, speculation, speculation_threshold,
+                               reduce_slowstart=reduce_slowstart)
+        self.lease_timeout = lease_timeout
+        # The RPC server and the failure detector share the store client
+        self.store_lock = threading.RLock()
+        self.partitioner = partitioner
+        self.partition_sample_bytes = partition_sample_bytes
+        self.phase_seconds = {}
+        # Spans of the master's phases and of every worker task attempt
+        self.tracer = Tracer('master')
+        self.trace_file = trace_file
+
+    def heartbeat(self, task_id, task_type, attempt=None, progress=None, counters=None, spans=None):
+        if spans:
+            self.tracer.extend(spans)
+        return self.tasks.renew(task_type, task_id, attempt, progress, counters)
+
+    def detect_failures(self):
+        # A worker that misses heartbeats for lease_timeout seconds, e.g. a
+        # preempted VM, loses its lease. Only its task is leased again, if
+        # need be on a worker taken from an early reducer.
+        while not self.tasks.done():
+            for task, attempt, worker in self.tasks.expire(self.lease_timeout):
+                print('Lease expired:', task.task_type, task.task_id, 'attempt', attempt, 'on', worker)
+                self.discard_output(task.task_type, task.task_id, attempt)
+            for task, attempt, worker in self.tasks.preempt():
+                print('Pre-empted', task.task_type, task.task_id, 'attempt', attempt, 'on', worker,
+                      'for a pending map task')
+                self.discard_output(task.task_type, task.task_id, attempt)
+            time.sleep(min(1, self.lease_timeout / 4))
+
+    def request_task(self, worker):
+        # Leases the next pending task to a worker. Without a task, 'wait'
+        # tells the worker whether to ask again later or shut down.
+        if worker in self.workers[self.pool_target:]:
+            # Surplus workers are let go when the pool shrinks between phases
+            self.retired.add(worker)
+            return {'wait': False}
+        lease = self.tasks.lease(worker)
+        if lease is None:
+            return {'wait': not self.tasks.done()}
+        task, attempt = lease
+        print('Leased', task.task_type, task.task_id, 'attempt', attempt, 'to', worker)
+        return {'task_type': task.task_type, 'task_id': task.task_id, 'attempt': attempt}
+
+    def task_status(self):
+        return self.tasks.status()
+
+    def job_counters(self):
+        # Counters of the job so far, summed per task type, and the wall
+        # clock time of every finished phase of the master
+        counters = self.tasks.counters()
+        maps = counters['map']
+        return {
+            'input': self.input_data,
+            'output': self.output_data,
+            'n_mappers': self.n_mappers,
+            'n_reducers': self.n_reducers,
+            'n_workers': len(self.workers),
+            'seconds': dict(self.phase_seconds),
+            'combiner_saved_records': maps.get('combine_input_records', 0) - maps.get('combine_output_records', 0),
+            'counters': counters,
+        }
 
-    def heartbeat(self, task_id, task_type):
-        print('Heartbeat from', task_id, task_type)
+    def job_trace(self):
+        return chrome_trace(self.tracer.snapshot())
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            end = time.time()
+            self.phase_seconds[name] = round(end - start, 3)
+            self.tracer.add(name, 'phase', start, end)
+
+    def write_summary(self):
+        # The final counters are kept next to the output as <output>_summary
+        summary = json.dumps(self.job_counters(), indent=4, sort_keys=True)
+        with self.store_lock:
+            self.fs_client.set(self.output_data + '_summary', summary)
+        print('Job summary:')
+        print(summary)
+
+    def write_trace(self):
+        # Stored as <output>_trace and, if trace_file is set, written there
+        # too. Both open in chrome://tracing or ui.perfetto.dev.
+        trace = self.job_trace()
+        with self.store_lock:
+            self.fs_client.set(self.output_data + '_trace', trace)
+        if self.trace_file is not None:
+            with open(self.trace_file, 'w') as out:
+                out.write(trace)
+            print('Trace written to', self.trace_file)
 
 
     def set_attribute(self, attribute, value):
@@ -103,84 +147,170 @@ class Master:
 
 
     def input_partition(self, files, n):
+        # Splits are (key, start, end) descriptors into the stored input, cut
+        # at whitespace. Mappers range-read their own slice from the store.
+        self.file_dict = {}
         for f in files:
-            print('Fetching data from', f)
-            data = self.fs_client.get(f)
-            total_size = len(data)
-            split_size = total_size // n
-            chunked_size = 0
-            chunk = 0
-            while chunk < n:
-                key = chunk
-                chunk_name = 'split_' + str(key) + '_' + f
-                if chunk < n - 1:
-                    chunked_size = (chunk + 1) * split_size
-                    self.fs_client.set(chunk_name,data[chunk * split_size :  chunked_size])
-                else:
-                    self.fs_client.set(chunk_name, data[chunk * split_size: ])
-                chunk+=1
-                if not key in self.file_dict:
-                    self.file_dict[key] = [chunk_name]
+            print('Partitioning', f)
+            size = self.fs_client.size(f)
+            if size is None:
+                print('Input not found in store:', f)
+                continue
+            read_window = lambda offset, length: self.fs_client.get_range(f, offset, length)
+            for chunk, (start, end) in enumerate(split_offsets(size, n, read_window)):
+                if not chunk in self.file_dict:
+                    self.file_dict[chunk] = [[f, start, end]]
                 else:
-                    self.file_list[key].append(chunk_name)
+                    self.file_dict[chunk].append([f, start, end])
+        for chunk in self.file_dict:
+            self.fs_client.set('split_' + str(chunk), json.dumps(self.file_dict[chunk]))
         return self.file_dict
 
-    def restart_reducers(self):
-        self.stop_reducers()
-        self.fs_client.set(self.output_data, '')
-        self.start_reducers()
-
-    def signal_complete(self, task_id, task_type):
+    def sample_partitions(self):
+        # The range partitioner needs boundaries before any mapper starts.
+        # They come from the map output of the first bytes of every split.
+        samples = []
+        for task_id in self.file_dict:
+            for f, start, end in self.file_dict[task_id]:
+                data = self.fs_client.get_range(f, start, min(end - start, self.partition_sample_bytes))
+                if data:
+                    samples.append((f, data.decode('utf-8', errors='ignore')))
+        boundaries = sample_boundaries(self.map_fn, samples, self.n_reducers)
+        self.fs_client.set('partition_boundaries', json.dumps(boundaries))
+        print('Range partition boundaries:', boundaries)
+        return boundaries
+
+    def reset_commits(self):
+        # Commits left over from an earlier job would point reducers at its output
+        pipeline = self.fs_client.pipeline()
+        for task_id in range(self.n_mappers):
+            pipeline.delete(commit_key(task_id))
+        pipeline.execute()
+        self.tasks = TaskTable(self.n_mappers, self.n_reducers, self.speculation, self.speculation_threshold,
+                               reduce_slowstart=self.reduce_slowstart)
+
+    def signal_complete(self, task_id, task_type, attempt=None, counters=None, spans=None):
         print("Signal complete", task_id, task_type)
-        self.factory.end_process(task_type, task_id)
-        
-
-    def create_worker(self, worker, target):
-        return {
-            "worker": mp.Process(target=target),
-            "timestamp": time.time(),
-            "status": "running",
-        }
+        if spans:
+            self.tracer.extend(spans)
+        if self.tasks.complete(task_type, task_id, attempt, counters):
+            self.commit(task_type, task_id, attempt)
+        else:
+            self.discard_output(task_type, task_id, attempt)
+        return True
 
-    def fault(self, task_id, task_type):
+    def commit(self, task_type, task_id, attempt):
+        # The first attempt of a task to finish wins. For a map task its id
+        # is written to map_commit_<task_id> with a single set, so reducers
+        # see either none or all of its pieces. Every other attempt is
+        # thrown away.
         if task_type == 'map':
-            self.restart_map(task_id)
-        elif task_type == 'reduce':
-            self.restart_reducers()
+            with self.store_lock:
+                self.fs_client.set(commit_key(task_id), str(attempt))
+        print('Committed', task_type, task_id, 'attempt', attempt)
+        for other in range(1, self.tasks.get(task_type, task_id).attempts + 1):
+            if other != attempt:
+                self.discard_output(task_type, task_id, other)
+
+    def discard_output(self, task_type, task_id, attempt):
+        pipeline = self.fs_client.pipeline()
+        if task_type == 'map':
+            for reduce_id in range(self.n_reducers):
+                pipeline.delete(intermediate_key(task_id, reduce_id, attempt))
+        else:
+            pipeline.delete(output_key(self.output_data, task_id, attempt))
+        with self.store_lock:
+            pipeline.execute()
+
+    def assemble_output(self):
+        # Committed reducer outputs are concatenated into output_data in
+        # reducer order and then removed. RPC calls that still come in from
+        # late attempts wait for the store client.
+        with self.store_lock:
+            self.fs_client.set(self.output_data, '')
+            for task_id in range(self.n_reducers):
+                key = output_key(self.output_data, task_id, self.tasks.get('reduce', task_id).committed)
+                batch = []
+                for line in self.fs_client.iter_lines(key):
+                    batch.append(line)
+                    if len(batch) >= 1000:
+                        self.fs_client.append_many(self.output_data, batch)
+                        batch = []
+                self.fs_client.append_many(self.output_data, batch)
+                self.fs_client.delete(key)
+
+    def fault(self, task_id, task_type, attempt=None, spans=None):
+        # Only the failed attempt is thrown away and its task is leased again
+        print('Fault in', task_type, task_id, 'attempt', attempt)
+        if spans:
+            self.tracer.extend(spans)
+        self.tasks.fail(task_type, task_id, attempt)
+        self.discard_output(task_type, task_id, attempt)
+        return True
 
     def get_pid(self, task_type, task_id):
         pid = str(task_type) + str(task_id)
         return pid
 
-    def start_workers(self, task_type):
-        if task_type == 'map':
-            passed_function = self.map_fn
-            count = self.n_mappers
-        elif task_type == 'reduce':
-            passed_function = self.reduce_fn
-            count = self.n_reducers
-        print('Starting workers of type', task_type)
-
-        if passed_function and count:
-            for task_id in range(count):
-                # files = self.splits[task_id] if task_type == 'map' else None
-                pid = self.get_pid(task_type, task_id)
-                operation = self.gcp.create_instance(pid, init_script="worker.sh", preemptible=True)
-                self.gcp.wait_for_operation(operation['name'])
-
-
-    def restart_map(self, task_id):
-        self.fs_client.set(self.splits[task_id], '')
-        worker = Worker(self.networkConfig, task_id, 'map',
-                        self.n_mappers, self.splits[task_id], self.output_data, self.map_fn)
-        recovery = self.create_worker(worker, worker.run)
-        self.mappers[task_id] = recovery
-        recovery.start()
-    
+    def pool_size(self, task_type):
+        # n_workers fixes the pool for the whole job. Otherwise it has one
+        # worker per task of the phase.
+        if self.n_workers is not None:
+            return self.n_workers
+        return self.n_mappers if task_type == 'map' else self.n_reducers
+
+    def start_workers(self, count):
+        # Workers are not tied to a task. Each one leases tasks from the
+        # master until none are left, so there can be more tasks than VMs.
+        self.pool_target = count
+        if count <= len(self.workers):
+            return
+        names = ['worker' + str(worker_id) for worker_id in range(len(self.workers), count)]
+        print('Starting', len(names), 'workers')
+        self.gcp.create_instances(names, init_script="worker.sh", preemptible=True)
+        self.workers.extend(names)
+
+    def resize_workers(self, count):
+        # The same workers run both phases. The pool only grows or shrinks
+        # when the phases want a different number of workers. Surplus
+        # workers are retired on their next request_task and their VMs are
+        # deleted by reap_workers.
+        if count > len(self.workers):
+            self.start_workers(count)
+        elif count < len(self.workers):
+            print('Retiring', len(self.workers) - count, 'workers')
+            self.pool_target = count
+
+    def reap_workers(self):
+        names = list(self.retired)
+        if len(names) == 0:
+            return
+        self.gcp.delete_instances(names)
+        for name in names:
+            self.retired.discard(name)
+            self.workers.remove(name)
+
+    def wait_for_phase(self, task_type, interval=5):
+        self.wait_until(lambda: self.tasks.is_phase_done(task_type), interval)
+
+    def wait_for_tasks(self, interval=5):
+        self.wait_until(self.tasks.done, interval)
+
+    def wait_until(self, done, interval, check_interval=0.1):
+        # Task counts are printed and retired workers reaped every interval
+        # seconds, but the end of a phase is noticed within check_interval
+        last = None
+        while not done():
+            if last is None or time.time() - last >= interval:
+                print('Tasks:', self.tasks.counts())
+                self.reap_workers()
+                last = time.time()
+            time.sleep(check_interval)
+
     def init_fs_client(self):
         fs_client_ip = self.gcp.get_ip_from_name('store', True)
         print('Store found at', fs_client_ip)
-        self.fs_client = FS_client((fs_client_ip, 80))
+        self.fs_client = FS_client((fs_client_ip, self.store_port))
         self.fs_client.connect()
         print(self.fs_client.get('key24'))
         # print(self.fs_client.set('key24', 'adsfasdfds'))
@@ -189,29 +319,35 @@ class Master:
 
     def run(self):
         try:
-            self.init_fs_client()
-            self.server_process = threading.Thread(target=self.server.run)
-            print('Starting Master')
-            self.server_process.start()
-            self.splits = self.input_partition([self.input_data], self.n_mappers)
-            ## TODO: cloud worker factory
-            self.start_workers('map')
-            self.gcp.update_instances()
-            for key in self.gcp.instances:
-                val = self.gcp.instances[key]
-                print('Running:', key, self.gcp.get_ip_from_name(key))
-            # time.sleep(60)
-            self.stop_instances()
-            self.start_workers('reduce')
-            time.sleep(30)
-            self.gcp.update_instances()
-            print(list(self.gcp.instances.keys()))
-            for key in self.gcp.instances:
-                val = self.gcp.instances[key]
-                print('Running:', key, self.gcp.get_ip_from_name(key))
-            # time.sleep(60)
-            self.stop_instances()
-            
+            start = time.time()
+            with self.phase('store_init'):
+                self.init_fs_client()
+                self.server_process = threading.Thread(target=self.server.run)
+                print('Starting Master')
+                self.server_process.start()
+            with self.phase('input_partition'):
+                self.splits = self.input_partition([self.input_data], self.n_mappers)
+                if self.partitioner == 'range':
+                    self.sample_partitions()
+                self.reset_commits()
+            self.failure_detector = threading.Thread(target=self.detect_failures, daemon=True)
+            self.failure_detector.start()
+            with self.phase('provisioning'):
+                self.start_workers(self.pool_size('map'))
+            # Map and reduce overlap when reducers start early
+            with self.phase('map'):
+                self.wait_for_phase('map')
+            with self.phase('reduce'):
+                self.resize_workers(self.pool_size('reduce'))
+                self.wait_for_tasks()
+            with self.phase('output'):
+                self.assemble_output()
+            with self.phase('teardown'):
+                self.stop_instances()
+            self.phase_seconds['total'] = round(time.time() - start, 3)
+            self.write_summary()
+            self.write_trace()
+
         except KeyboardInterrupt:
             self.stop()
         self.stop()
@@ -223,24 +359,7 @@ class Master:
             process.close()
 
 
-    def stop_mappers(self):
-        for key in self.mappers:
-            p = self.mappers[key]["worker"]
-            self.stop_process(p)
-        self.mappers = {}
-
-    def stop_reducers(self):
-        for key in self.reducers:
-            p = self.reducers[key]["worker"]
-            self.stop_process(p)
-        self.reducers = {}
-
     def stop(self):
-        print("Stopping mappers")
-        self.stop_mappers()
-        print("Stopping reducers")
-        self.stop_reducers()
-        
         print("Stopping RPC sercer")
         try:
             self.server.kill()
@@ -252,26 +371,21 @@ class Master:
 
     def stop_instances(self):
         self.gcp.update_instances()
-        for key in self.gcp.instances:
-            if 'map' in key or 'reduce' in key:
-                operation = self.gcp.delete_instance(key)
-                self.gcp.wait_for_operation(operation['name'])
-
-def myFunc(i):
-    print(i)
-
-def run_local():
-    module = importlib.import_module('word_count_map')
-    map_fn = getattr(module, 'map_fn')
-    module = importlib.import_module('word_count_reduce')
-    reduce_fn = getattr(module, 'reduce_fn')
-    master = Master(('', 80), [myFunc], 4, 4, map_fn, reduce_fn)
-    # master.run()
+        names = [key for key in self.gcp.instances if 'worker' in key or 'map' in key or 'reduce' in key]
+        if len(names) > 0:
+            self.gcp.delete_instances(names)
+
+def run_local(mode='word_count'):
+    cfg = Config('config.json', mode)
+    cfg.parse()
+    engine = LocalEngine(cfg)
+    engine.run()
 
 def run_cloud():
     cfg = Config('config.json')
     cfg.parse()
-    gcp = CloudInterface(cfg.project, cfg.zone)
+    cfg.check_cloud()
+    gcp = CloudInterface(cfg.project, cfg.zone, operation_rate=cfg.operation_rate, operation_burst=cfg.operation_burst)
     master = Master(
         gcp,
         cfg.network_config,
@@ -281,7 +395,15 @@ def run_cloud():
         cfg.map_fn,
         cfg.reduce_fn,
         cfg.input_data,
-        cfg.output_data
+        cfg.output_data,
+        cfg.partitioner,
+        cfg.partition_sample_bytes,
+        cfg.worker_count,
+        cfg.lease_timeout,
+        cfg.speculation,
+        cfg.speculation_threshold,
+        cfg.reduce_slowstart,
+        cfg.trace_file
     )
     master.run()
     
@@ -0,0 +1,34 @@
+class OutputBuffer:
+    def __init__(self, fs_client, key, max_bytes=65536, max_records=1000):
+        self.fs_client = fs_client
+        self.key = key
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self.records = []
+        self.size = 0
+        self.flushes = 0
+        self.records_out = 0
+        self.bytes_out = 0
+
+    def add(self, record):
+        self.records.append(record)
+        # Size in UTF-8 bytes with the newline; an ASCII string's length
+        # already is that, without encoding it
+        self.size += (len(record) if record.isascii() else len(record.encode('utf-8'))) + 1
+        if self.size >= self.max_bytes or len(self.records) >= self.max_records:
+            self.flush()
+
+    def take(self):
+        records = self.records
+        if len(records) > 0:
+            self.records_out += len(records)
+            self.bytes_out += self.size
+            self.records = []
+            self.size = 0
+            self.flushes += 1
+        return records
+
+    def flush(self):
+        records = self.take()
+        if len(records) > 0:
+            self.fs_client.append_many(self.key, records)
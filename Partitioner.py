@@ -0,0 +1,125 @@
+import bisect
+import json
+import sys
+import time
+import zlib
+
+from utils import hash_function
+
+
+class HashPartitioner:
+    # CRC32 is stable across processes and machines, unlike hash(), and much
+    # cheaper than SHA-1. Skewed text repeats the same keys a lot, so results
+    # are memoized too.
+    def __init__(self, n_partitions, cache_size=100000):
+        self.n_partitions = n_partitions if n_partitions > 0 else 1
+        self.cache_size = cache_size
+        self.cache = {}
+
+    def partition(self, key):
+        p = self.cache.get(key)
+        if p is None:
+            p = zlib.crc32(key.encode('utf-8')) % self.n_partitions
+            if len(self.cache) >= self.cache_size:
+                self.cache = {}
+            self.cache[key] = p
+        return p
+
+    def partition_batch(self, keys):
+        cache = self.cache
+        n = self.n_partitions
+        crc32 = zlib.crc32
+        partitions = []
+        for key in keys:
+            p = cache.get(key)
+            if p is None:
+                p = crc32(key.encode('utf-8')) % n
+                cache[key] = p
+            partitions.append(p)
+        if len(cache) > self.cache_size:
+            self.cache = {}
+        return partitions
+
+
+class SHA1Partitioner:
+    def __init__(self, n_partitions):
+        self.n_partitions = n_partitions
+
+    def partition(self, key):
+        return hash_function(key, self.n_partitions)
+
+    def partition_batch(self, keys):
+        return [hash_function(key, self.n_partitions) for key in keys]
+
+
+class RangePartitioner:
+    # Sends every key to the partition whose range contains it, so reducer r
+    # only holds keys smaller than those of reducer r + 1 and concatenating
+    # the outputs in order gives globally sorted output.
+    def __init__(self, n_partitions, boundaries):
+        self.n_partitions = n_partitions
+        self.boundaries = boundaries
+
+    def partition(self, key):
+        return bisect.bisect_right(self.boundaries, key)
+
+    def partition_batch(self, keys):
+        boundaries = self.boundaries
+        return [bisect.bisect_right(boundaries, key) for key in keys]
+
+
+def sample_boundaries(map_fn, samples, n_partitions):
+    # samples are (name, text) pieces of the input. Their map output keys are
+    # sorted and cut at n_partitions - 1 evenly spaced quantiles.
+    keys = []
+    for name, text in samples:
+        for k, v in map_fn(name, text):
+            keys.append(str(k))
+    keys.sort()
+    if len(keys) == 0 or n_partitions <= 1:
+        return []
+    return [keys[len(keys) * i // n_partitions] for i in range(1, n_partitions)]
+
+
+def create_partitioner(name, n_partitions, boundaries=None):
+    if name == 'hash':
+        return HashPartitioner(n_partitions)
+    elif name == 'sha1':
+        return SHA1Partitioner(n_partitions)
+    elif name == 'range':
+        if boundaries is None:
+            raise ValueError('The range partitioner needs sampled boundaries')
+        return RangePartitioner(n_partitions, boundaries)
+    raise ValueError('Unknown partitioner: ' + str(name))
+
+
+def benchmark(path='corpus_utf.txt', n_partitions=5, rounds=5):
+    from word_count_map import map_fn
+    keys = [k for k, v in map_fn(path, open(path, 'r', encoding='utf-8').read())]
+    results = {'keys': len(keys)}
+
+    def run(name, fn):
+        best = None
+        for _ in range(rounds):
+            start = time.perf_counter()
+            fn()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = {'seconds': round(best, 6), 'keys_per_second': int(len(keys) / best)}
+
+    def each(create):
+        def fn():
+            partitioner = create()
+            return [partitioner.partition(k) for k in keys]
+        return fn
+
+    boundaries = sample_boundaries(map_fn, [(path, open(path, 'r', encoding='utf-8').read(65536))], n_partitions)
+    run('sha1 hash_function', lambda: [hash_function(k, n_partitions) for k in keys])
+    run('hash partition', each(lambda: HashPartitioner(n_partitions)))
+    run('hash partition_batch', lambda: HashPartitioner(n_partitions).partition_batch(keys))
+    run('range partition_batch', lambda: RangePartitioner(n_partitions, boundaries).partition_batch(keys))
+    return results
+
+
+if __name__ == '__main__':
+    print(json.dumps(benchmark(*sys.argv[1:2]), indent=4))
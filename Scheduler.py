@@ -0,0 +1,254 @@
+import threading
+import time
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+
+
+class Task:
+    def __init__(self, task_type, task_id):
+        self.task_type = task_type
+        self.task_id = task_id
+        self.state = PENDING
+        self.attempts = 0
+        # attempt -> [worker, lease time, last heartbeat, progress, counters]
+        # for every attempt still running
+        self.running = {}
+        self.committed = None
+        self.backups = 0
+        self.rate = None
+        self.seconds = None
+        self.counters = {}
+        self.pending_since = time.time()
+
+    def current_counters(self):
+        # The committed attempt's counters, or those of the running attempt
+        # that got furthest, so backups are not counted twice
+        if self.state == DONE or len(self.running) == 0:
+            return self.counters
+        return max(self.running.values(), key=lambda lease: lease[3])[4]
+
+    def status(self):
+        return {
+            'task_type': self.task_type,
+            'task_id': self.task_id,
+            'state': self.state,
+            'attempts': self.attempts,
+            'running': sorted(self.running),
+            'committed': self.committed,
+            'backups': self.backups,
+            'progress': 1 if self.state == DONE else max([lease[3] for lease in self.running.values()], default=0),
+            'seconds': self.seconds,
+            'counters': self.current_counters(),
+        }
+
+
+class TaskTable:
+    # Workers pull tasks from the table instead of being started with one.
+    # Reduce tasks are handed out once reduce_slowstart of the map tasks
+    # are done, and only to workers that find no map task to run.
+    def __init__(self, n_mappers, n_reducers, speculation=True, speculation_threshold=0.5,
+                 speculation_min_seconds=5, reduce_slowstart=1.0, reduce_preempt_seconds=5):
+        self.tasks = {
+            'map': [Task('map', task_id) for task_id in range(n_mappers)],
+            'reduce': [Task('reduce', task_id) for task_id in range(n_reducers)],
+        }
+        self.speculation = speculation
+        self.speculation_threshold = speculation_threshold
+        self.speculation_min_seconds = speculation_min_seconds
+        self.reduce_slowstart = reduce_slowstart
+        self.reduce_preempt_seconds = reduce_preempt_seconds
+        # When the last map task was committed. Reducers that started early
+        # only make progress of their own from then on.
+        self.maps_done_at = None
+        self.lock = threading.Lock()
+
+    def get(self, task_type, task_id):
+        return self.tasks[task_type][task_id]
+
+    def phase_done(self, task_type):
+        return all(task.state == DONE for task in self.tasks[task_type])
+
+    def reduce_ready(self):
+        maps = self.tasks['map']
+        return sum(1 for task in maps if task.state == DONE) >= self.reduce_slowstart * len(maps)
+
+    def is_phase_done(self, task_type):
+        with self.lock:
+            return self.phase_done(task_type)
+
+    def done(self):
+        with self.lock:
+            return self.phase_done('map') and self.phase_done('reduce')
+
+    def requeue(self, task):
+        if task.state == RUNNING and len(task.running) == 0:
+            task.state = PENDING
+            task.pending_since = time.time()
+
+    def start_attempt(self, task, worker):
+        task.state = RUNNING
+        task.attempts += 1
+        now = time.time()
+        task.running[task.attempts] = [worker, now, now, 0, {}]
+        return task, task.attempts
+
+    def lease(self, worker):
+        # Returns (task, attempt) or None if nothing can be handed out yet.
+        # Once no task of a phase is pending, idle workers get backup
+        # attempts of the stragglers of that phase.
+        with self.lock:
+            for task_type in ('map', 'reduce'):
+                if task_type == 'reduce' and not self.reduce_ready():
+                    return None
+                for task in self.tasks[task_type]:
+                    if task.state == PENDING:
+                        return self.start_attempt(task, worker)
+                if self.speculation and (task_type == 'map' or self.maps_done_at is not None):
+                    for task in self.stragglers(task_type):
+                        if worker not in [lease[0] for lease in task.running.values()]:
+                            task.backups += 1
+                            return self.start_attempt(task, worker)
+            return None
+
+    def stragglers(self, task_type):
+        # Running tasks whose progress rate is below speculation_threshold
+        # times the median rate of the phase. Finished tasks count with the
+        # rate they finished at. Every task gets at most one backup. Reduce
+        # attempts are timed from the end of the map phase at the earliest,
+        # so waiting for map commits does not make them look slow.
+        now = time.time()
+        rates = [task.rate for task in self.tasks[task_type] if task.rate is not None]
+        candidates = []
+        for task in self.tasks[task_type]:
+            if task.state != RUNNING:
+                continue
+            for worker, leased, heartbeat, progress, counters in task.running.values():
+                elapsed = now - self.started(task_type, leased)
+                if elapsed < self.speculation_min_seconds:
+                    continue
+                rates.append(progress / elapsed)
+                if task.backups == 0 and len(task.running) == 1:
+                    candidates.append((task, progress / elapsed))
+        if len(rates) == 0:
+            return []
+        median = sorted(rates)[len(rates) // 2]
+        return [task for task, rate in candidates if rate < self.speculation_threshold * median]
+
+    def started(self, task_type, leased):
+        if task_type == 'reduce' and self.maps_done_at is not None:
+            return max(leased, self.maps_done_at)
+        return leased
+
+    def renew(self, task_type, task_id, attempt, progress=None, counters=None):
+        # A heartbeat extends the lease of a running attempt. False tells
+        # the worker that the attempt is no longer wanted.
+        with self.lock:
+            lease = self.get(task_type, task_id).running.get(attempt)
+            if lease is None:
+                return False
+            lease[2] = time.time()
+            if progress is not None:
+                lease[3] = progress
+            if counters is not None:
+                lease[4] = counters
+            return True
+
+    def expire(self, timeout):
+        # Running attempts without a heartbeat for timeout seconds are
+        # dropped, and their tasks go back to pending. Returns the
+        # (task, attempt, worker) triples that expired.
+        expired = []
+        now = time.time()
+        with self.lock:
+            for task_type in self.tasks:
+                for task in self.tasks[task_type]:
+                    for attempt, (worker, leased, heartbeat, progress, counters) in list(task.running.items()):
+                        if now - heartbeat > timeout:
+                            del task.running[attempt]
+                            expired.append((task, attempt, worker))
+                    self.requeue(task)
+        return expired
+
+    def preempt(self):
+        # Reducers that started early wait in the shuffle until every map
+        # task is committed. When a map task goes back to pending, e.g. its
+        # VM was preempted, and no worker leases it within
+        # reduce_preempt_seconds, all workers are held by such reducers. The
+        # reduce attempt that got least far then loses its lease, which
+        # frees its worker for the map task. Returns the (task, attempt,
+        # worker) triples that were pre-empted.
+        preempted = []
+        now = time.time()
+        with self.lock:
+            waiting = [task for task in self.tasks['map']
+                       if task.state == PENDING and now - task.pending_since > self.reduce_preempt_seconds]
+            leases = [(task, attempt, lease) for task in self.tasks['reduce'] for attempt, lease in task.running.items()]
+            leases.sort(key=lambda item: (item[2][3], -item[2][1]))
+            for map_task, (task, attempt, lease) in zip(waiting, leases):
+                del task.running[attempt]
+                self.requeue(task)
+                # The next reducer is only pre-empted if the freed worker
+                # does not take the map task either
+                map_task.pending_since = now
+                preempted.append((task, attempt, lease[0]))
+        return preempted
+
+    def complete(self, task_type, task_id, attempt, counters=None):
+        # True if attempt is the first to finish the task and must be
+        # committed. An attempt that lost its lease can no longer commit.
+        # Other attempts of the task lose theirs, which stops them.
+        with self.lock:
+            task = self.get(task_type, task_id)
+            lease = task.running.pop(attempt, None)
+            if lease is None or task.state == DONE:
+                return False
+            task.state = DONE
+            task.committed = attempt
+            now = time.time()
+            task.seconds = now - lease[1]
+            task.rate = 1 / max(now - self.started(task_type, lease[1]), 1e-6)
+            if task_type == 'map' and self.maps_done_at is None and self.phase_done('map'):
+                self.maps_done_at = now
+            task.counters = counters if counters is not None else lease[4]
+            task.running = {}
+            return True
+
+    def fail(self, task_type, task_id, attempt):
+        # The task goes back to pending unless another attempt is still running
+        with self.lock:
+            task = self.get(task_type, task_id)
+            task.running.pop(attempt, None)
+            self.requeue(task)
+
+    def counts(self):
+        with self.lock:
+            counts = {}
+            for task_type in self.tasks:
+                for task in self.tasks[task_type]:
+                    key = task_type + '_' + task.state
+                    counts[key] = counts.get(key, 0) + 1
+            return counts
+
+    def counters(self):
+        # Counters summed per task type. Finished tasks count with their
+        # committed attempt, running ones with their latest heartbeat.
+        with self.lock:
+            totals = {}
+            for task_type in self.tasks:
+                total = {'tasks_done': 0, 'attempts': 0, 'backups': 0, 'task_seconds': 0}
+                for task in self.tasks[task_type]:
+                    total['attempts'] += task.attempts
+                    total['backups'] += task.backups
+                    if task.state == DONE:
+                        total['tasks_done'] += 1
+                        total['task_seconds'] += task.seconds
+                    for name, value in task.current_counters().items():
+                        total[name] = total.get(name, 0) + value
+                totals[task_type] = total
+            return totals
+
+    def status(self):
+        with self.lock:
+            return [task.status() for task_type in self.tasks for task in self.tasks[task_type]]
@@ -0,0 +1,102 @@
+import heapq
+import inspect
+import os
+import sys
+import tempfile
+from itertools import groupby
+from operator import itemgetter
+
+
+# Memory a buffered record takes on top of its two strings: the tuple and
+# its slot in the buffer list
+RECORD_OVERHEAD = sys.getsizeof((None, None)) + 8
+
+
+class ExternalSorter:
+    # Collects (key, value) records for a reducer. Once the buffer holds
+    # buffer_bytes it is sorted and spilled to a run file on local disk, and
+    # groups() k-way merges the runs so memory stays bounded by the buffer.
+    # At most merge_factor runs are open at once; with more, groups() first
+    # merges them in passes of merge_factor runs into longer runs.
+    def __init__(self, buffer_bytes=32 * 1024 * 1024, work_dir=None, merge_factor=64):
+        self.buffer_bytes = buffer_bytes
+        self.work_dir = work_dir
+        self.merge_factor = max(2, merge_factor)
+        self.buffer = []
+        self.size = 0
+        self.runs = []
+        self.records = 0
+        self.merged = 0
+        self.spills = 0
+        self.merge_passes = 0
+
+    def add(self, key, value):
+        self.buffer.append((key, value))
+        self.size += sys.getsizeof(key) + sys.getsizeof(value) + RECORD_OVERHEAD
+        self.records += 1
+        if self.size >= self.buffer_bytes:
+            self.spill()
+
+    def write_run(self, records):
+        run = tempfile.NamedTemporaryFile('w+', encoding='utf-8', prefix='run_', dir=self.work_dir, delete=False)
+        for k, v in records:
+            run.write(k + '\t' + v + '\n')
+        run.close()
+        return run.name
+
+    def spill(self):
+        self.buffer.sort(key=itemgetter(0))
+        self.runs.append(self.write_run(self.buffer))
+        self.buffer = []
+        self.size = 0
+        self.spills += 1
+
+    def merge_runs(self, paths):
+        return heapq.merge(*[self.read_run(path) for path in paths], key=itemgetter(0))
+
+    def read_run(self, path):
+        with open(path, 'r', encoding='utf-8') as run:
+            for line in run:
+                k, v = line.rstrip('\n').split('\t', 1)
+                yield k, v
+
+    def groups(self):
+        if len(self.runs) == 0:
+            self.buffer.sort(key=itemgetter(0))
+            records = iter(self.buffer)
+        else:
+            if len(self.buffer) > 0:
+                self.spill()
+            while len(self.runs) > self.merge_factor:
+                paths = self.runs[:self.merge_factor]
+                merged = self.write_run(self.merge_runs(paths))
+                self.runs = self.runs[self.merge_factor:] + [merged]
+                for path in paths:
+                    os.remove(path)
+                self.merge_passes += 1
+            records = self.merge_runs(self.runs)
+        for key, group in groupby(self.count(records), key=itemgetter(0)):
+            yield key, (v for k, v in group)
+
+    def count(self, records):
+        for record in records:
+            self.merged += 1
+            yield record
+
+    def close(self):
+        for path in self.runs:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.runs = []
+        self.buffer = []
+
+
+def grouped_reducer(reduce_fn):
+    # reduce_fn(key, values) returns the value for key. Older reduce_fn(tuple_data)
+    # functions take a list of (key, value) pairs and return pairs; they are
+    # called once per key so they never see more than one group.
+    if len(inspect.signature(reduce_fn).parameters) >= 2:
+        return lambda key, values: [(key, reduce_fn(key, values))]
+    return lambda key, values: reduce_fn([(key, v) for v in values])
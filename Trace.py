@@ -0,0 +1,72 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Tracer:
+    # Records spans as Chrome trace events ('X' events with a start and a
+    # duration in microseconds). Spans name their process and thread, e.g.
+    # 'worker3' and 'MainThread', and chrome_trace turns those into ids.
+    def __init__(self, process):
+        self.process = process
+        self.events = []
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def span(self, name, category='task', **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, category, start, time.time(), args)
+
+    def add(self, name, category, start, end, args=None):
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': int(start * 1e6),
+            'dur': int((end - start) * 1e6),
+            'pid': self.process,
+            'tid': threading.current_thread().name,
+        }
+        if args:
+            event['args'] = args
+        with self.lock:
+            self.events.append(event)
+
+    def extend(self, events):
+        with self.lock:
+            self.events.extend(events)
+
+    def take(self):
+        # Hands out the spans recorded since the last call
+        with self.lock:
+            events = self.events
+            self.events = []
+        return events
+
+    def snapshot(self):
+        with self.lock:
+            return list(self.events)
+
+
+def chrome_trace(events):
+    # Numbers the processes and threads, names them with metadata events
+    # and moves the trace to start at 0
+    pids = {}
+    tids = {}
+    trace = []
+    start = min([event['ts'] for event in events], default=0)
+    for event in sorted(events, key=lambda event: event['ts']):
+        process, thread = event['pid'], event['tid']
+        if process not in pids:
+            pids[process] = len(pids)
+            trace.append({'name': 'process_name', 'ph': 'M', 'pid': pids[process], 'args': {'name': process}})
+        if (process, thread) not in tids:
+            tids[(process, thread)] = len(tids)
+            trace.append({'name': 'thread_name', 'ph': 'M', 'pid': pids[process], 'tid': tids[(process, thread)],
+                          'args': {'name': thread}})
+        trace.append(dict(event, ts=event['ts'] - start, pid=pids[process], tid=tids[(process, thread)]))
+    return json.dumps({'traceEvents': trace, 'displayTimeUnit': 'ms'})
@@ -1,29 +1,46 @@
-import json
-from Master import Master
-import importlib
+from Configuration import Config
+from LocalEngine import LocalEngine
 import sys
 
 
-def get_network_config(config):
-    address, port = config
-    return (address, port)
+def run_cloud(cfg):
+    from GCP import CloudInterface
+    from Master import Master
+    cfg.check_cloud()
+    gcp = CloudInterface(cfg.project, cfg.zone, operation_rate=cfg.operation_rate, operation_burst=cfg.operation_burst)
+    master = Master(
+        gcp,
+        cfg.network_config,
+        [],
+        cfg.mapper_count,
+        cfg.reducer_count,
+        cfg.map_fn,
+        cfg.reduce_fn,
+        cfg.input_data,
+        cfg.output_data,
+        cfg.partitioner,
+        cfg.partition_sample_bytes,
+        cfg.worker_count,
+        cfg.lease_timeout,
+        cfg.speculation,
+        cfg.speculation_threshold,
+        cfg.reduce_slowstart,
+        cfg.trace_file
+    )
+    master.run()
 
-def get_map_method(location):
-    module = importlib.import_module(location)
-    method = getattr(module, 'map_fn')
-    return method
 
+def run_local(cfg):
+    engine = LocalEngine(cfg)
+    engine.run()
 
-def get_reduce_method(location):
-    module = importlib.import_module(location)
-    method = getattr(module, 'reduce_fn')
-    return method
 
 if __name__ == '__main__':
     
 
-    if len(sys.argv) != 2:
-        print("ERROR: Expected 1 argument")
+    if len(sys.argv) not in [2, 3]:
+        print("ERROR: Expected 1 or 2 arguments")
+        print("Usage: python3 UserProgram.py <mode> [local]")
         sys.exit()
 
     mode = sys.argv[1]
@@ -34,17 +51,10 @@ if __name__ == '__main__':
         print(permitted_modes)
         sys.exit()
 
-    f = open('config.json', 'r')
-    config = json.loads(f.read())
-    
-    config = config[mode]
-    network_config = get_network_config(config['network_config'])
-    input_data = config['input_data']
-    mapper_count = config['n_mappers']
-    reducer_count = config['n_reducers']
-    output_data = config['output_data']
-    map_fn = get_map_method(config['map_fn'])
-    reduce_fn = get_reduce_method(config['reduce_fn'])
-
-    master = Master(network_config, [], mapper_count, reducer_count, map_fn, reduce_fn, input_data, output_data)
-    master.run()
+    cfg = Config('config.json', mode)
+    cfg.parse()
+
+    if len(sys.argv) == 3 and sys.argv[2] == 'local':
+        run_local(cfg)
+    else:
+        run_cloud(cfg)
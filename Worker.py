@@ -1,35 +1,128 @@
-from simple_key_value_store.Client import Client as FS_client
-from utils import hash_function
+from simple_key_value_store.Client import Client as FS_client, ClientPool
+from utils import parse_record, intermediate_key, commit_key, output_key, split_offsets
 from rpc.Client import Client
+from concurrent.futures import ThreadPoolExecutor
+import json
+import queue
+import socket
 import threading
 import time
 import sys
+import uuid
 from Configuration import Config
 from GCP import CloudInterface
+from Combiner import Combiner
+from OutputBuffer import OutputBuffer
+from Shuffle import ExternalSorter, grouped_reducer
+from Partitioner import create_partitioner
+from Trace import Tracer
+
+class TaskCancelled(Exception):
+    pass
+
 
 class Worker:
 
-    def __init__(self, networkConfig, n_mappers, n_reducers, output_location):
+    def __init__(self, networkConfig, n_mappers, n_reducers, output_location, combine_fn=None, combiner_size=10000,
+                 buffer_bytes=65536, buffer_records=1000, sort_buffer_bytes=32 * 1024 * 1024,
+                 partitioner='hash', shuffle_fetchers=4, heartbeat_interval=2, map_chunk_bytes=1024 * 1024,
+                 compression_level=0):
         self.networkConfig = networkConfig
         self.n_mappers = n_mappers
         self.n_reducers = n_reducers
         self.output_location = output_location
+        self.combine_fn = combine_fn
+        self.combiner_size = combiner_size
+        self.buffer_bytes = buffer_bytes
+        self.buffer_records = buffer_records
+        self.buffers = {}
+        self.sort_buffer_bytes = sort_buffer_bytes
+        self.partitioner_name = partitioner
+        self.partitioner = None
+        self.shuffle_fetchers = shuffle_fetchers
+        self.map_chunk_bytes = map_chunk_bytes
+        self.compression_level = compression_level
+        self.commit_poll_interval = 1
+        self.intermediate_buffers = []
         self.heartbeat = None
+        self.heartbeat_interval = heartbeat_interval
         self.complete = False
+        self.cancelled = False
+        self.progress = 0
+        self.counters = {}
+        self.combiner = None
+        self.sorter = None
+        self.shuffle_pool = None
+        self.store_base = {}
+        # Spans go to the master with the next heartbeat
+        self.tracer = Tracer(socket.gethostname())
+        self.wakeup = threading.Event()
+        self.fs_client = None
+        self.rpc = None
 
-    def init(self):
+    def assign(self, task_type, task_id, function, storeConfig, attempt=None):
         self.task_id = task_id
         self.task_type = task_type
-        self.files = files
         self.function = function
-        self.fs_client = FS_client()
-        self.fs_client.connect()
-        self.rpc = Client(networkConfig)
+        self.attempt = attempt if attempt is not None else uuid.uuid4().hex[:8]
+        self.buffers = {}
+        self.complete = False
+        self.cancelled = False
+        self.progress = 0
+        self.counters = {}
+        self.combiner = None
+        self.sorter = None
+        self.shuffle_pool = None
+        self.wakeup.clear()
+        # Connections are kept across the tasks a worker runs
+        if self.fs_client is None:
+            self.storeConfig = storeConfig
+            # Intermediate pieces and reducer outputs are written compressed
+            # when the job sets a compression level
+            self.fs_client = FS_client(storeConfig, compress_level=self.compression_level)
+            self.fs_client.connect()
+        self.store_base = self.fs_client.counters()
+        if self.rpc is None:
+            self.rpc = Client(self.networkConfig)
+
+    def count(self, name, value=1):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def task_counters(self):
+        # Counters of the running attempt, including those kept by its
+        # combiner, sorter, output buffers and store connections
+        counters = dict(self.counters)
+        if self.combiner is not None:
+            counters['combine_input_records'] = self.combiner.records_in
+            counters['combine_output_records'] = self.combiner.records_out
+            counters['combine_fn_seconds'] = self.combiner.seconds
+        if self.sorter is not None:
+            counters['sort_spills'] = self.sorter.spills
+            counters['sort_merge_passes'] = self.sorter.merge_passes
+        prefix = 'intermediate_' if self.task_type == 'map' else 'output_'
+        for buffer in list(self.buffers.values()):
+            counters[prefix + 'records'] = counters.get(prefix + 'records', 0) + buffer.records_out
+            counters[prefix + 'bytes'] = counters.get(prefix + 'bytes', 0) + buffer.bytes_out
+        store = {name: value - self.store_base.get(name, 0) for name, value in self.fs_client.counters().items()}
+        if self.shuffle_pool is not None:
+            for name, value in self.shuffle_pool.counters().items():
+                store[name] += value
+        for name, value in store.items():
+            counters['store_' + name] = value
+        return counters
 
     def heartbeat_thread(self):
         while not self.complete:
-            self.rpc.run('heartbeat', self.task_id, self.task_type)
-            time.sleep(2)
+            # The master answers False once this attempt is no longer wanted,
+            # e.g. when a backup attempt of the task finished first
+            spans = self.tracer.take()
+            result = self.rpc.run('heartbeat', self.task_id, self.task_type, self.attempt, self.progress,
+                                  self.task_counters(), spans)
+            if result is None:
+                self.tracer.extend(spans)
+            elif result is False:
+                self.cancelled = True
+            self.wakeup.wait(self.heartbeat_interval)
 
     def start_heartbeat(self):
         self.heartbeat = threading.Thread(target=self.heartbeat_thread)
@@ -37,6 +130,7 @@ class Worker:
 
     def stop_heartbeat(self):
         self.complete = True
+        self.wakeup.set()
         while self.heartbeat.is_alive():
             print("Stopping hearbeat", self.task_id, self.task_type)
             self.heartbeat.join(5)
@@ -47,72 +141,326 @@ class Worker:
 
     def stop(self):
         self.stop_heartbeat()
-        self.rpc.run('signal_complete', self.task_id, self.task_type)
+        self.rpc.run('signal_complete', self.task_id, self.task_type, self.attempt, self.task_counters(),
+                     self.tracer.take())
 
 
     def run(self):
-        # try:
         self.init()
-        if(self.task_type == 'map'):
-            self.map()
-
-        elif(self.task_type == 'reduce'):
-            self.reduce()
+        try:
+            with self.tracer.span(self.task_type + ' ' + str(self.task_id), attempt=self.attempt):
+                if(self.task_type == 'map'):
+                    self.map()
 
+                elif(self.task_type == 'reduce'):
+                    self.reduce()
+        except TaskCancelled:
+            self.stop_heartbeat()
+            print(self.task_type + str(self.task_id) + ':', 'Attempt', self.attempt, 'cancelled')
+            # Whatever was flushed after the master discarded this attempt
+            self.delete_buffers()
+            return False
+        except Exception as e:
+            self.stop_heartbeat()
+            print(self.task_type + str(self.task_id) + ':', 'Failed with', repr(e))
+            self.rpc.run('fault', self.task_id, self.task_type, self.attempt, self.tracer.take())
+            # The store connection may be left halfway through a request
+            self.fs_client.close()
+            self.fs_client = None
+            return False
         self.stop()
-        # except:
-        #     print("Something went wrong")
-        #     sys.exit()
-            # self.rpc.run('fault', self.task_id, self.task_type)
-
-    def emit_intermediate(self, key, value):
-        hash_value = hash_function(key, self.n_reducers)
-        store_key = 'intermediate_' + str(hash_value)
-        store_value = str(key) + ':' + str(value)
-        self.fs_client.append(store_key, store_value)
+        return True
+
+    def serve(self, name, map_fn, reduce_fn, storeConfig, poll_interval=2):
+        # Leases tasks from the master until the job is done. When no task is
+        # free yet the worker asks again, since a running one may still fail.
+        self.rpc = Client(self.networkConfig)
+        self.tracer.process = name
+        while True:
+            task = self.rpc.run('request_task', name)
+            if task is None:
+                time.sleep(poll_interval)
+                continue
+            if 'task_type' not in task:
+                if not task['wait']:
+                    print('No tasks left')
+                    return
+                time.sleep(poll_interval)
+                continue
+            function = map_fn if task['task_type'] == 'map' else reduce_fn
+            self.assign(task['task_type'], task['task_id'], function, storeConfig, task['attempt'])
+            self.run()
+
+    def check_cancelled(self):
+        if self.cancelled:
+            raise TaskCancelled()
+
+    def get_buffer(self, store_key):
+        buffer = self.buffers.get(store_key)
+        if buffer is None:
+            buffer = OutputBuffer(self.fs_client, store_key, self.buffer_bytes, self.buffer_records)
+            self.buffers[store_key] = buffer
+        return buffer
+
+    def delete_buffers(self):
+        pipeline = self.fs_client.pipeline()
+        for store_key in self.buffers:
+            pipeline.delete(store_key)
+        pipeline.execute()
+
+    def flush_buffers(self):
+        # The final flush of every partition goes out as one pipeline
+        pipeline = self.fs_client.pipeline()
+        for store_key in self.buffers:
+            records = self.buffers[store_key].take()
+            if len(records) > 0:
+                pipeline.append_many(store_key, records)
+        pipeline.execute()
+
+    def emit_intermediate_batch(self, pairs):
+        keys = [str(k) for k, v in pairs]
+        partitions = self.partitioner.partition_batch(keys)
+        buffers = self.intermediate_buffers
+        for p, k, (_, v) in zip(partitions, keys, pairs):
+            buffers[p].add(k + ':' + str(v))
 
     def emit(self, key, value):
-        store_key = self.output_location
+        store_key = output_key(self.output_location, self.task_id, self.attempt)
         store_value = str(key) + ':' + str(value)
-        self.fs_client.append(store_key, store_value)
+        self.get_buffer(store_key).add(store_value)
+
+    def get_splits(self):
+        splits = self.fs_client.get('split_' + str(self.task_id))
+        if splits is None:
+            print('No input split found for', self.task_type + str(self.task_id))
+            return []
+        return json.loads(splits)
+
+    def create_partitioner(self):
+        boundaries = None
+        if self.partitioner_name == 'range':
+            boundaries = json.loads(self.fs_client.get('partition_boundaries'))
+        self.partitioner = create_partitioner(self.partitioner_name, self.n_reducers, boundaries)
+        self.intermediate_buffers = [self.get_buffer(intermediate_key(self.task_id, r, self.attempt))
+                                     for r in range(self.n_reducers)]
+        # Attempt numbers start at 1 in every job, so an earlier job run
+        # against the same store can have left pieces under these keys
+        self.delete_buffers()
 
     def map(self):
-        for f in self.files:
-            data = self.fs_client.get(f)
-            processed_data = self.function(f, data)
-            for i, (k,v) in enumerate(processed_data):
-                # print(self.task_type + str(self.task_id) + ':' + 'Emitting intermediate data', i+1, 'of', len(processed_data))
+        self.create_partitioner()
+        combiner = None
+        if self.combine_fn is not None:
+            combiner = Combiner(self.combine_fn, self.emit_intermediate_batch, self.combiner_size)
+        self.combiner = combiner
+        splits = self.get_splits()
+        total = max(1, sum(end - start for f, start, end in splits))
+        consumed = 0
+        for f, start, end in splits:
+            if end <= start:
+                continue
+            # Splits are mapped in whitespace-aligned chunks of about
+            # map_chunk_bytes, so progress can be reported as they go
+            read_window = lambda offset, length: self.fs_client.get_range(f, start + offset, length)
+            n_chunks = -(-(end - start) // self.map_chunk_bytes)
+            for chunk_start, chunk_end in split_offsets(end - start, n_chunks, read_window):
+                self.check_cancelled()
+                if chunk_end <= chunk_start:
+                    continue
+                with self.tracer.span('fetch', 'step', bytes=chunk_end - chunk_start):
+                    data = self.fs_client.get_range(f, start + chunk_start, chunk_end - chunk_start).decode('utf-8')
+                with self.tracer.span('compute', 'step'):
+                    started = time.perf_counter()
+                    processed_data = self.function(f, data)
+                    self.count('map_fn_seconds', time.perf_counter() - started)
+                self.count('map_input_bytes', chunk_end - chunk_start)
+                self.count('map_output_records', len(processed_data))
+                with self.tracer.span('emit', 'step', records=len(processed_data)):
+                    if combiner is None:
+                        self.emit_intermediate_batch(processed_data)
+                    else:
+                        for k, v in processed_data:
+                            combiner.add(k, v)
+                consumed += chunk_end - chunk_start
+                self.progress = consumed / total
+        with self.tracer.span('emit', 'step'):
+            if combiner is not None:
+                combiner.flush()
+                print(self.task_type + str(self.task_id) + ':', 'Combined', combiner.records_in, 'records into', combiner.records_out)
+            self.flush_buffers()
 
-                self.emit_intermediate(k,v)
-        
 
-    def reduce(self):
-        data = self.fs_client.get('intermediate_' + str(self.task_id))
-        data = data.split('\n')
-        tuple_data = []
-        for t in data:
+    def committed_attempts(self, client, map_ids):
+        # Reads the commit markers of all map_ids in one pipelined round trip
+        pipeline = client.pipeline()
+        for map_id in map_ids:
+            pipeline.get(commit_key(map_id))
+        return dict(zip(map_ids, pipeline.execute()))
+
+    def fetch_map_output(self, pool, map_id, attempt, lines, stop, batch_size=1000):
+        with self.tracer.span('fetch map ' + str(map_id), 'step'):
+            self.fetch_lines(pool, map_id, attempt, lines, stop, batch_size)
+
+    def fetch_lines(self, pool, map_id, attempt, lines, stop, batch_size):
+        client = pool.acquire()
+        try:
+            # Chunks are cut at their last b'\n' before decoding, so a line or
+            # a UTF-8 sequence is never split, and the bytes of each piece
+            # are counted as they arrive
+            rest = b''
+            for chunk in client.stream(intermediate_key(map_id, self.task_id, attempt)):
+                data = rest + chunk
+                cut = data.rfind(b'\n') + 1
+                rest = data[cut:]
+                self.put_lines(lines, data[:cut], batch_size)
+                if stop.is_set():
+                    break
+            else:
+                if len(rest) > 0:
+                    self.put_lines(lines, rest + b'\n', batch_size)
+        except Exception:
+            pool.release(client, broken=True)
+            raise
+        pool.release(client)
+
+    def put_lines(self, lines, data, batch_size):
+        # Queues the lines of data in batches, the first of which carries
+        # the byte count of all of them
+        batch = data.decode('utf-8').split('\n')
+        batch.pop()
+        for start in range(0, len(batch), batch_size):
+            lines.put((batch[start:start + batch_size], len(data) if start == 0 else 0))
+
+    def shuffle(self, sorter):
+        # A reduce task may start before the map phase is over. Each piece
+        # is fetched as soon as its mapper is committed, on one of several
+        # parallel connections, and goes into the sorter's sorted runs
+        # while the remaining mappers still run. The bounded queue keeps
+        # fetchers from running far ahead of the sorter.
+        lines = queue.Queue(self.shuffle_fetchers * 4)
+        pool = ClientPool(self.storeConfig, self.shuffle_fetchers + 1)
+        self.shuffle_pool = pool
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(self.shuffle_fetchers, thread_name_prefix='fetch')
+        futures = []
+
+        def fetch(map_id, attempt):
+            try:
+                self.fetch_map_output(pool, map_id, attempt, lines, stop)
+                lines.put(None)
+            except Exception as e:
+                lines.put(e)
+
+        def poll():
+            pending = list(range(self.n_mappers))
+            client = pool.acquire()
             try:
-                k,v = t.split(':')
-                tuple_data.append((k,v))
-            except ValueError:
-                pass
-        processed_data = self.function(tuple_data)
-        for i, (k, v) in enumerate(processed_data):
-            self.emit(k, v)
-            # print(self.task_type + str(self.task_id) + ':' + 'Emitting data', i+1, 'of', len(processed_data))
+                while len(pending) > 0 and not stop.is_set():
+                    attempts = self.committed_attempts(client, pending)
+                    for map_id in pending:
+                        if attempts[map_id]:
+                            futures.append(executor.submit(fetch, map_id, attempts[map_id]))
+                    pending = [map_id for map_id in pending if not attempts[map_id]]
+                    if len(pending) > 0:
+                        stop.wait(self.commit_poll_interval)
+            except Exception as e:
+                pool.release(client, broken=True)
+                lines.put(e)
+                return
+            pool.release(client)
+
+        poller = threading.Thread(target=poll, daemon=True)
+        poller.start()
+        done = 0
+        try:
+            while done < self.n_mappers:
+                try:
+                    item = lines.get(timeout=self.commit_poll_interval)
+                except queue.Empty:
+                    self.check_cancelled()
+                    continue
+                if item is None:
+                    done += 1
+                    self.progress = 0.5 * done / self.n_mappers
+                    continue
+                if isinstance(item, Exception):
+                    raise item
+                self.check_cancelled()
+                batch, size = item
+                self.count('shuffle_records', len(batch))
+                self.count('shuffle_bytes', size)
+                for line in batch:
+                    record = parse_record(line)
+                    if record is not None:
+                        sorter.add(*record)
+        except BaseException:
+            # Fetchers blocked on the full queue have to be let go first
+            stop.set()
+            while poller.is_alive() or not all(future.done() for future in futures):
+                try:
+                    lines.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            raise
+        finally:
+            poller.join()
+            executor.shutdown()
+            pool.close()
+
+    def reduce(self):
+        # Clears what an earlier job left under this attempt's output key
+        self.get_buffer(output_key(self.output_location, self.task_id, self.attempt))
+        self.delete_buffers()
+        sorter = ExternalSorter(self.sort_buffer_bytes)
+        self.sorter = sorter
+        try:
+            with self.tracer.span('fetch', 'step'):
+                self.shuffle(sorter)
+            reduce = grouped_reducer(self.function)
+            with self.tracer.span('compute', 'step'):
+                for key, values in sorter.groups():
+                    self.check_cancelled()
+                    self.progress = 0.5 + 0.5 * sorter.merged / max(1, sorter.records)
+                    # Includes reading the key's values from the sorted runs
+                    started = time.perf_counter()
+                    pairs = reduce(key, values)
+                    self.count('reduce_fn_seconds', time.perf_counter() - started)
+                    self.count('reduce_input_groups')
+                    for k, v in pairs:
+                        self.emit(k, v)
+        finally:
+            sorter.close()
+        if sorter.spills > 0:
+            print(self.task_type + str(self.task_id) + ':', 'Merged', sorter.spills, 'sorted runs')
+        with self.tracer.span('emit', 'step'):
+            self.flush_buffers()
     
 def run_cloud():
     cfg = Config('config.json')
     cfg.parse()
+    cfg.check_cloud()
+    name = sys.argv[1] if len(sys.argv) > 1 else socket.gethostname()
+    gcp = CloudInterface(cfg.project, cfg.zone)
+    master_ip = gcp.get_ip_from_name('master')
+    store_ip = gcp.get_ip_from_name('store')
     worker = Worker(
-        cfg.network_config,
+        (master_ip, cfg.network_config[1]),
         cfg.mapper_count,
         cfg.reducer_count,
-        cfg.output_data
+        cfg.output_data,
+        cfg.combine_fn,
+        cfg.combiner_size,
+        cfg.buffer_bytes,
+        cfg.buffer_records,
+        cfg.sort_buffer_bytes,
+        cfg.partitioner,
+        cfg.shuffle_fetchers,
+        cfg.heartbeat_interval,
+        cfg.map_chunk_bytes,
+        cfg.compression_level
     )
     print('CFG parsed and worker initialized')
-    worker.init()
-    worker.run()
+    worker.serve(name, cfg.map_fn, cfg.reduce_fn, (store_ip, 80))
 
 if __name__ == "__main__":
     run_cloud()
\ No newline at end of file
@@ -1,32 +1,59 @@
-import xmlrpc.client
+import socket
+import threading
+
+try:
+    from rpc import protocol
+except ImportError:
+    import protocol
 
 class Client:
-    def __init__(self, networkConfig=('', 80)):
-        self.url = self.getURL(networkConfig)
-        self.stub = xmlrpc.client.ServerProxy(self.url)
-        try:
-            if len(self.stub.system.listMethods()) > 0:
-                print('Connected to RPC server at', self.url)
-        except:
-            print('Server not running')
-    def getURL(self, config):
-        return 'http://' + config[0] + ':' + str(config[1])
-    
+    # One persistent connection to the server, opened on the first call and
+    # again after an error. Calls from several threads take turns on it.
+    def __init__(self, networkConfig=('', 80), timeout=30):
+        self.networkConfig = networkConfig
+        self.timeout = timeout
+        self.socket = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        sock = socket.create_connection(self.networkConfig, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.socket = sock
+        print('Connected to RPC server at', self.networkConfig)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    def call(self, method, *args):
+        if self.socket is None:
+            self.connect()
+        protocol.send_message(self.socket, protocol.CALL, [method, args])
+        message = protocol.recv_message(self.socket)
+        if message is None:
+            raise ConnectionError('RPC server closed the connection')
+        return message
+
     def run(self, method, *args):
-        try:
-            serverMethod = getattr(self.stub, method)
-            serverMethod(*args)
-        except xmlrpc.client.Fault as f:
-            print(f.faultString)
-            print("Requested method:", method, "not found")
-        except Exception as e:
-            print("Unknown error")
-            print(e)
-            
+        with self.lock:
+            try:
+                kind, result = self.call(method, *args)
+            except Exception as e:
+                print("Unknown error")
+                print(e)
+                self.close()
+                return None
+        if kind == protocol.ERROR:
+            print(result)
+            print("Requested method:", method, "failed")
+            return None
+        return result
+
 
 def main():
-    client = Client(('34.123.134.188', 8000))  
-    client.run('hello') 
-    
+    client = Client(('34.123.134.188', 8000))
+    client.run('hello')
+
 if __name__ == '__main__':
     main()
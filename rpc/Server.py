@@ -1,26 +1,76 @@
-from xmlrpc.server import SimpleXMLRPCServer
-from xmlrpc.server import SimpleXMLRPCRequestHandler
+import socket
+import threading
+
+try:
+    from rpc import protocol
+except ImportError:
+    import protocol
 
-class RequestHandler(SimpleXMLRPCRequestHandler):
-    rpc_paths = ('/RPC2',)
 
 class Server(object):
+    # Each client keeps one connection open and gets its own thread, so a
+    # slow call does not hold up the heartbeats of other workers
     quit = False
-    def __init__(self, networkConfig=('', 80), methods=[]):
-        self.server = SimpleXMLRPCServer(
-            networkConfig, requestHandler=RequestHandler, allow_none=True, logRequests=False)
-        self.server.register_introspection_functions()
-        self.methods = methods
-        for method in self.methods:
-            self.server.register_function(method)
-        self.server.register_function(self.kill)
-    
+    def __init__(self, networkConfig=('', 80), methods=[], backlog=128):
+        self.networkConfig = networkConfig
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(networkConfig)
+        self.socket.listen(backlog)
+        self.methods = {}
+        for method in methods:
+            self.register_function(method)
+        self.register_function(self.kill)
+
+    def register_function(self, method):
+        self.methods[method.__name__] = method
+
     def kill(self):
         self.quit = True
+        # Wakes up the accept in run
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        return True
+
+    def dispatch(self, method, args):
+        if method not in self.methods:
+            return protocol.ERROR, 'method "' + str(method) + '" is not supported'
+        try:
+            return protocol.RESULT, self.methods[method](*args)
+        except Exception as e:
+            return protocol.ERROR, method + ': ' + repr(e)
+
+    def connectionThread(self, connection):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with connection:
+            while not self.quit:
+                try:
+                    message = protocol.recv_message(connection)
+                    if message is None:
+                        return
+                    kind, body = message
+                    if kind != protocol.CALL:
+                        return
+                    kind, result = self.dispatch(body[0], body[1])
+                    try:
+                        protocol.send_message(connection, kind, result)
+                    except TypeError as e:
+                        protocol.send_message(connection, protocol.ERROR, body[0] + ': ' + repr(e))
+                except (OSError, ValueError, IndexError):
+                    # A broken frame leaves the stream out of sync
+                    return
 
     def run(self):
         while not self.quit:
-            self.server.handle_request()
+            try:
+                connection, addr = self.socket.accept()
+            except OSError:
+                break
+            t = threading.Thread(target=self.connectionThread, args=(connection,), daemon=True)
+            t.start()
 
 
 def main():
@@ -0,0 +1,45 @@
+import json
+import struct
+
+# Every message is HEADER (magic, kind, body length) followed by a JSON
+# body. A call is [method, args]; the reply is the result or an error
+# message. Connections stay open and carry one call at a time.
+# The body is JSON on purpose: heartbeats carry open-ended counters and
+# trace spans, and the C json module encodes and decodes them faster than
+# a tagged binary encoding written in Python, at a similar size.
+MAGIC = b'RP'
+HEADER = struct.Struct('>2sBI')
+
+CALL = 1
+RESULT = 2
+ERROR = 3
+
+
+def send_message(sock, kind, body):
+    data = json.dumps(body, separators=(',', ':')).encode('utf-8')
+    sock.sendall(HEADER.pack(MAGIC, kind, len(data)) + data)
+
+
+def recv_exactly(sock, n):
+    view = memoryview(bytearray(n))
+    received = 0
+    while received < n:
+        count = sock.recv_into(view[received:])
+        if count == 0:
+            return None
+        received += count
+    return view.obj
+
+
+def recv_message(sock):
+    # Returns (kind, body), or None once the peer closed the connection
+    header = recv_exactly(sock, HEADER.size)
+    if header is None:
+        return None
+    magic, kind, length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError('Bad frame magic')
+    data = recv_exactly(sock, length)
+    if data is None:
+        return None
+    return kind, json.loads(data.decode('utf-8'))
@@ -4,4 +4,4 @@ cd ~
 rm -rf gcp_map_reduce
 git clone https://github.com/aniruddhavpatil/gcp_map_reduce.git
 cd gcp_map_reduce/simple_key_value_store
-nohup python3 Server.py > store.log &
\ No newline at end of file
+nohup python3 Server.py --mode async > store.log &
\ No newline at end of file
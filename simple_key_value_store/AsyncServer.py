@@ -0,0 +1,109 @@
+import asyncio
+import functools
+import signal
+import socket
+import struct
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from simple_key_value_store import protocol
+    from simple_key_value_store.Server import Server
+except ImportError:
+    import protocol
+    from Server import Server
+
+
+class ResponseBuffer(object):
+    # Stands in for the socket while a request runs on an I/O thread, so the
+    # Server handlers can be reused unchanged.
+    def __init__(self):
+        self.chunks = []
+
+    def sendall(self, data):
+        self.chunks.append(data)
+
+    def sendfile(self, file, offset=0, count=None):
+        file.seek(offset)
+        self.chunks.append(file.read(count))
+
+
+class AsyncServer(Server):
+    def __init__(self, networkConfig=('', 80), ioThreads=8, **kwargs):
+        super().__init__(networkConfig, **kwargs)
+        self.executor = ThreadPoolExecutor(max_workers=ioThreads)
+        # Open connections, each a writer and the task serving it
+        self.connections = {}
+
+    async def readRequest(self, reader, binary):
+        if binary:
+            header = await reader.readexactly(protocol.HEADER.size)
+            opcode, flags, keyLength, valueLength = protocol.unpack_header(header)
+            key = await reader.readexactly(keyLength)
+            value = await reader.readexactly(valueLength)
+            return functools.partial(self.dispatchBinary, opcode=opcode, flags=flags, key=key.decode('utf-8'), value=value)
+        raw_msglen = await reader.readexactly(4)
+        msglen = struct.unpack('>I', raw_msglen)[0]
+        rawMessage = await reader.readexactly(msglen)
+        if rawMessage == protocol.HELLO:
+            return None
+        return functools.partial(self.dispatchText, rawMessage=rawMessage)
+
+    async def handleConnection(self, reader, writer):
+        sock = writer.get_extra_info('socket')
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.connections[writer] = asyncio.current_task()
+        loop = asyncio.get_running_loop()
+        binary = False
+        try:
+            while True:
+                handler = await self.readRequest(reader, binary)
+                if handler is None:
+                    writer.write(struct.pack('>I', len(protocol.HELLO_OK)) + protocol.HELLO_OK)
+                    binary = True
+                else:
+                    response = ResponseBuffer()
+                    # Disk I/O and cache fills run on the bounded executor
+                    await loop.run_in_executor(self.executor, functools.partial(handler, response))
+                    writer.writelines(response.chunks)
+                # One request in flight per connection: the next one is not
+                # read until the client has taken this response.
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            pass
+        except (ValueError, IndexError, OSError) as e:
+            print('Closing connection:', e)
+        finally:
+            del self.connections[writer]
+            writer.close()
+
+    async def serve(self):
+        self.socket.setblocking(False)
+        server = await asyncio.start_server(self.handleConnection, sock=self.socket, backlog=self.backlog)
+        stopping = asyncio.Event()
+        # SIGTERM is handled on the loop itself, between callbacks, so it
+        # stops the server instead of raising out of whichever connection
+        # happens to be running
+        if threading.current_thread() is threading.main_thread():
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+        print("Socket is listening at", self.networkConfig, "(async)")
+        await stopping.wait()
+        server.close()
+        # Closing the transports ends each connection at its next read, once
+        # a request already running has been answered
+        tasks = list(self.connections.values())
+        for writer in list(self.connections):
+            writer.close()
+        if len(tasks) > 0:
+            await asyncio.wait(tasks)
+
+    def run(self):
+        self.prepare()
+        try:
+            asyncio.run(self.serve())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.executor.shutdown(wait=True)
+            self.close()
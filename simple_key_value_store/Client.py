@@ -2,20 +2,55 @@ import socket
 import struct
 import time
 import sys
+import json
+import threading
+import queue
 
+try:
+    from simple_key_value_store import protocol
+except ImportError:
+    import protocol
 
 class Client(object):
-    def __init__(self, networkConfig=('', 80), tests=None, debug=False, name="Client"):
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.settimeout(5)
+    def __init__(self, networkConfig=('', 80), tests=None, debug=False, name="Client", binary=True, timeout=5,
+                 compress_level=0, compress_min_bytes=256):
         self.networkConfig = networkConfig
         self.tests = tests
         self.debug = debug
         self.name = name 
+        self.binary = binary
+        self.timeout = timeout
+        # Values written through this client are compressed with zlib at
+        # compress_level (1-9, 0 is off) once the server agreed to it
+        self.compress_level = compress_level
+        self.compress_min_bytes = compress_min_bytes
+        self.compression = False
+        # Binary requests sent, waits for their responses, the time spent in
+        # those waits and the bytes on the wire
+        self.requests = 0
+        self.round_trips = 0
+        self.wait_seconds = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        # Set once a request failed halfway, which leaves the connection
+        # out of sync
+        self.broken = False
+        self.socket = self.createSocket()
 
-    def createMessage(self, command, key=None, value=None):
+    def createSocket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return sock
+
+    def createMessage(self, command, key=None, value=None, count=None):
         message = ''
-        if command == 'set' or command == 'append':
+        if command == 'mappend':
+            if key is not None and value is not None and count is not None:
+                message = command + ' ' + key + ' ' + str(count) + ' ' + str(len(value)) + ' \r\n' + value + '\r\n'
+            else:
+                return None
+        elif command == 'set' or command == 'append':
             if key is not None and value is not None:
                 message = command + ' ' + key + ' ' + str(len(value)) + ' \r\n' + value + '\r\n'
             else:
@@ -88,11 +123,208 @@ class Client(object):
     
     def connect(self):
         self.socket.connect(self.networkConfig)
+        if self.binary and self.negotiate():
+            self.negotiate_features()
+
+    def negotiate(self):
+        # Servers without binary support never answer the hello, so fall
+        # back to the text protocol on a fresh connection.
+        try:
+            self.send(protocol.HELLO)
+            if self.receive() == protocol.HELLO_OK:
+                return True
+        except socket.timeout:
+            pass
+        print('Store does not support the binary protocol, using text')
+        self.binary = False
+        self.socket.close()
+        self.socket = self.createSocket()
+        self.socket.connect(self.networkConfig)
+        return False
+
+    def negotiate_features(self):
+        # Servers without compression answer ERROR or leave the flag unset
+        self.send_request(protocol.FEATURES, '', flags=protocol.COMPRESSED)
+        self.round_trips += 1
+        status, flags, payload = self.read_frame()
+        self.compression = status == protocol.OK and flags & protocol.COMPRESSED != 0
+        return self.compression
+
+    @property
+    def accept(self):
+        return protocol.ACCEPT_COMPRESSED if self.compression else 0
+
+    def encode(self, value, newline=False):
+        # Returns the flags and bytes to send for a value. A compressed
+        # append carries its own trailing newline, which the server adds to
+        # plain ones.
+        value = protocol.to_bytes(value)
+        if not self.compression or self.compress_level <= 0 or len(value) < self.compress_min_bytes:
+            return 0, value
+        if newline:
+            value = value + b'\n'
+        return protocol.COMPRESSED, protocol.compress_block(value, self.compress_level)
+
+    def frame(self, opcode, key, value=b'', flags=0):
+        key = protocol.to_bytes(key)
+        value = protocol.to_bytes(value)
+        return [protocol.pack_header(opcode, len(key), len(value), flags) + key, value]
+
+    def send_request(self, opcode, key, value=b'', flags=0):
+        header, value = self.frame(opcode, key, value, flags)
+        self.requests += 1
+        self.bytes_sent += len(header) + len(value)
+        try:
+            self.socket.sendall(header)
+            if len(value) > 0:
+                self.socket.sendall(value)
+        except OSError:
+            self.broken = True
+            raise
+
+    def request(self, opcode, key, value=b'', flags=0):
+        self.send_request(opcode, key, value, flags)
+        self.round_trips += 1
+        return self.read_response()
+
+    def read_frame(self):
+        start = time.perf_counter()
+        try:
+            header = protocol.recv_exactly(self.socket, protocol.HEADER.size)
+            if header is None:
+                raise ConnectionError('Store closed the connection')
+            status, flags, keyLength, valueLength = protocol.unpack_header(header)
+            payload = protocol.recv_exactly(self.socket, valueLength)
+            if payload is None:
+                raise ConnectionError('Store closed the connection')
+        except (OSError, ValueError):
+            self.broken = True
+            raise
+        self.wait_seconds += time.perf_counter() - start
+        self.bytes_received += len(header) + len(payload)
+        return status, flags, payload
+
+    def counters(self):
+        return {
+            'requests': self.requests,
+            'round_trips': self.round_trips,
+            'wait_seconds': self.wait_seconds,
+            'bytes_sent': self.bytes_sent,
+            'bytes_received': self.bytes_received,
+        }
+
+    def read_response(self):
+        # Whole values that come back compressed are decompressed here
+        status, flags, payload = self.read_frame()
+        if flags & protocol.COMPRESSED:
+            payload = protocol.decompress_blocks(payload)
+        return status, payload
 
     def greet(self):
         print('Client')
 
+    def get_bytes(self, key):
+        if not self.binary:
+            value = self.get(key)
+            return None if value is None else value.encode('utf-8')
+        status, payload = self.request(protocol.GET, key, flags=self.accept)
+        if status != protocol.OK:
+            return None
+        return payload
+
+    def get_range(self, key, offset, length):
+        if not self.binary:
+            value = self.get_bytes(key)
+            return None if value is None else value[offset:offset + length]
+        status, payload = self.request(protocol.GETRANGE, key, protocol.RANGE.pack(offset, length))
+        if status != protocol.OK:
+            return None
+        return payload
+
+    def size(self, key):
+        if not self.binary:
+            value = self.get_bytes(key)
+            return None if value is None else len(value)
+        status, payload = self.request(protocol.SIZE, key)
+        if status != protocol.OK:
+            return None
+        return protocol.SIZE_VALUE.unpack(payload)[0]
+
+    def stats(self):
+        if not self.binary:
+            return None
+        status, payload = self.request(protocol.STATS, '')
+        if status != protocol.OK:
+            return None
+        return json.loads(payload.decode('utf-8'))
+
+    def pipeline(self, depth=64):
+        return Pipeline(self, depth)
+
+    def stream(self, key, chunk_size=1 << 20, offset=0, end=None, prefetch=4):
+        if not self.binary:
+            value = self.get_bytes(key)
+            if value is not None:
+                yield value[offset:end]
+            return
+        flags = 0
+        if end is None:
+            # A whole compressed value is streamed as stored and decompressed
+            # here. Explicit offsets always refer to the plain value.
+            self.send_request(protocol.SIZE, key, flags=self.accept if offset == 0 else 0)
+            self.round_trips += 1
+            status, flags, payload = self.read_frame()
+            if status != protocol.OK:
+                return
+            end = protocol.SIZE_VALUE.unpack(payload)[0]
+        decoder = protocol.BlockDecoder() if flags & protocol.COMPRESSED else None
+        range_flags = self.accept if decoder is not None else 0
+        # Keep a few range reads in flight so the next chunk is already on
+        # the wire while the caller works on this one.
+        inflight = 0
+        try:
+            while offset < end or inflight > 0:
+                while offset < end and inflight < prefetch:
+                    length = min(chunk_size, end - offset)
+                    self.send_request(protocol.GETRANGE, key, protocol.RANGE.pack(offset, length), range_flags)
+                    offset += length
+                    inflight += 1
+                self.round_trips += 1
+                status, flags, chunk = self.read_frame()
+                inflight -= 1
+                if status != protocol.OK or not chunk:
+                    # The value was deleted or cut short while it streamed
+                    raise ValueError('Stream of ' + key + ' ended early with status ' + str(status))
+                if decoder is not None:
+                    chunk = decoder.feed(chunk)
+                    if not chunk:
+                        continue
+                yield chunk
+            if decoder is not None:
+                decoder.close()
+        finally:
+            # Responses the caller no longer wants must still be read off the
+            # connection before it can be used again.
+            while inflight > 0:
+                self.read_frame()
+                inflight -= 1
+
+    def iter_lines(self, key, chunk_size=1 << 20):
+        # Lines are cut at b'\n' before decoding, so a chunk boundary never
+        # splits a UTF-8 sequence.
+        rest = b''
+        for chunk in self.stream(key, chunk_size):
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8')
+        if rest:
+            yield rest.decode('utf-8')
+
     def get(self, key):
+        if self.binary:
+            value = self.get_bytes(key)
+            return None if value is None else value.decode('utf-8')
         message = self.createMessage('get', key=key)
         # print('message',message)
         self.send(message)
@@ -104,18 +336,215 @@ class Client(object):
         return None
 
     def set(self, key, value):
+        if self.binary:
+            flags, value = self.encode(value)
+            status, payload = self.request(protocol.SET, key, value, flags)
+            return status == protocol.OK
         message = self.createMessage('set', key=key, value=value)
         # print('message', message)
         self.send(message)
         response = self.receive()
-        print(response)
+        return response == b'STORED\r\n'
     
     def append(self, key, value):
+        if self.binary:
+            flags, value = self.encode(value, newline=True)
+            status, payload = self.request(protocol.APPEND, key, value, flags)
+            return status == protocol.OK
         message = self.createMessage('append', key=key, value=value)
         # print('message', message)
         self.send(message)
         response = self.receive()
-        # print(response)
+        return response == b'STORED\r\n'
+
+    def append_many(self, key, records):
+        if len(records) == 0:
+            return
+        if self.binary:
+            flags, value = self.encode(b'\n'.join(protocol.to_bytes(record) for record in records), newline=True)
+            status, payload = self.request(protocol.MAPPEND, key, value, flags)
+            return status == protocol.OK
+        message = self.createMessage('mappend', key=key, value='\n'.join(records), count=len(records))
+        self.send(message)
+        response = self.receive()
+        return response == b'STORED\r\n'
+
+    def delete(self, key):
+        # Only the binary protocol can delete keys
+        if not self.binary:
+            return False
+        status, payload = self.request(protocol.DELETE, key)
+        return status == protocol.OK
+
+    def close(self):
+        self.socket.close()
+
+
+class Pipeline(object):
+    # Queues requests and sends them back to back on one connection. The
+    # server answers in order, so responses are matched by position. At most
+    # `depth` requests or `max_bytes` of request data are in flight at once.
+    def __init__(self, client, depth=64, max_bytes=1 << 20):
+        self.client = client
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.requests = []
+
+    def add(self, opcode, key, value, decode, fallback, flags=0):
+        self.requests.append((opcode, key, value, decode, fallback, flags))
+        return self
+
+    def get(self, key):
+        ok = lambda status, payload: payload.decode('utf-8') if status == protocol.OK else None
+        return self.add(protocol.GET, key, b'', ok, lambda: self.client.get(key), self.client.accept)
+
+    def get_bytes(self, key):
+        ok = lambda status, payload: payload if status == protocol.OK else None
+        return self.add(protocol.GET, key, b'', ok, lambda: self.client.get_bytes(key), self.client.accept)
+
+    def get_range(self, key, offset, length):
+        ok = lambda status, payload: payload if status == protocol.OK else None
+        return self.add(protocol.GETRANGE, key, protocol.RANGE.pack(offset, length), ok,
+                        lambda: self.client.get_range(key, offset, length))
+
+    def set(self, key, value):
+        ok = lambda status, payload: status == protocol.OK
+        flags, data = self.client.encode(value)
+        return self.add(protocol.SET, key, data, ok, lambda: self.client.set(key, value), flags)
+
+    def append(self, key, value):
+        ok = lambda status, payload: status == protocol.OK
+        flags, data = self.client.encode(value, newline=True)
+        return self.add(protocol.APPEND, key, data, ok, lambda: self.client.append(key, value), flags)
+
+    def append_many(self, key, records):
+        ok = lambda status, payload: status == protocol.OK
+        flags, data = self.client.encode(b'\n'.join(protocol.to_bytes(record) for record in records), newline=True)
+        return self.add(protocol.MAPPEND, key, data, ok, lambda: self.client.append_many(key, records), flags)
+
+    def delete(self, key):
+        ok = lambda status, payload: status == protocol.OK
+        return self.add(protocol.DELETE, key, b'', ok, lambda: self.client.delete(key))
+
+    def execute(self):
+        requests = self.requests
+        self.requests = []
+        if not self.client.binary:
+            return [fallback() for opcode, key, value, decode, fallback, flags in requests]
+        results = []
+        sent = 0
+        while sent < len(requests):
+            window = []
+            count = 0
+            size = 0
+            while sent < len(requests) and count < self.depth and (count == 0 or size < self.max_bytes):
+                opcode, key, value, decode, fallback, flags = requests[sent]
+                frame = self.client.frame(opcode, key, value, flags)
+                window.extend(frame)
+                size += len(frame[0]) + len(frame[1])
+                count += 1
+                sent += 1
+            data = b''.join(window)
+            try:
+                self.client.socket.sendall(data)
+                self.client.requests += count
+                self.client.bytes_sent += len(data)
+                self.client.round_trips += 1
+                for i in range(count):
+                    status, payload = self.client.read_response()
+                    results.append(requests[len(results)][3](status, payload))
+            except Exception:
+                # Responses of this window may still be unread, so the
+                # connection cannot be used for other requests any more
+                self.client.broken = True
+                raise
+        return results
+
+
+class ClientPool(object):
+    # Connections shared by the threads of one process. A thread takes a
+    # client for one or more requests and gives it back when done.
+    def __init__(self, networkConfig=('', 80), size=4, **kwargs):
+        self.networkConfig = networkConfig
+        self.size = size
+        self.kwargs = kwargs
+        self.idle = queue.LifoQueue()
+        self.created = 0
+        self.clients = []
+        # Counters of the clients that were discarded
+        self.discarded = {}
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            try:
+                return self.idle.get_nowait()
+            except queue.Empty:
+                pass
+            with self.lock:
+                create = self.created < self.size
+                if create:
+                    self.created += 1
+            if create:
+                break
+            # Wake up now and then in case a broken client freed a slot
+            try:
+                return self.idle.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        client = Client(self.networkConfig, **self.kwargs)
+        with self.lock:
+            self.clients.append(client)
+        try:
+            client.connect()
+        except OSError:
+            self.discard(client)
+            raise
+        return client
+
+    def release(self, client, broken=False):
+        # A broken client is closed instead of being handed out again, and
+        # the next acquire opens a fresh connection in its place
+        if broken or client.broken:
+            self.discard(client)
+            return
+        self.idle.put(client)
+
+    def discard(self, client):
+        client.close()
+        with self.lock:
+            if client in self.clients:
+                self.clients.remove(client)
+                for name, value in client.counters().items():
+                    self.discarded[name] = self.discarded.get(name, 0) + value
+            self.created -= 1
+
+    def run(self, method, *args):
+        client = self.acquire()
+        try:
+            result = getattr(client, method)(*args)
+        except (OSError, ConnectionError, ValueError):
+            self.release(client, broken=True)
+            raise
+        self.release(client)
+        return result
+
+    def counters(self):
+        # Summed over every connection the pool has opened
+        with self.lock:
+            clients = list(self.clients)
+            totals = dict(self.discarded)
+        for client in clients:
+            for name, value in client.counters().items():
+                totals[name] = totals.get(name, 0) + value
+        return totals
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
 
 
 if __name__ == '__main__':
@@ -4,16 +4,39 @@ import sys
 import struct
 import os
 import threading
+import argparse
+import json
+import signal
+
+try:
+    from simple_key_value_store import protocol
+    from simple_key_value_store.cache import LRUCache
+    from simple_key_value_store.storage import FileStorage, LogStorage
+except ImportError:
+    import protocol
+    from cache import LRUCache
+    from storage import FileStorage, LogStorage
 
 
 class Server(object):
-    def __init__(self, networkConfig=('', 80), debug=False):
+    def __init__(self, networkConfig=('', 80), debug=False, cacheBytes=64 * 1024 * 1024, maxItemBytes=None, backlog=128,
+                 storage='file'):
         self.networkConfig = networkConfig
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.settimeout(None)
         self.socket.bind(networkConfig)
         self.store = os.path.join(os.getcwd(), 'store')
         self.debug = debug
+        self.cache = LRUCache(cacheBytes, maxItemBytes)
+        if storage == 'log':
+            self.storage = LogStorage(os.path.join(self.store, 'segments'))
+        else:
+            self.storage = FileStorage(self.store)
+        self.locks = [threading.Lock() for _ in range(64)]
+        self.backlog = backlog
+        # Keys whose stored value is a run of compressed blocks
+        self.compressed = set()
+        self.compressLevel = 1
 
     # START REFERENCE: https://stackoverflow.com/questions/17667903/python-socket-receive-large-amount-of-data
     def send_msg(self, sock, msg):
@@ -41,14 +64,93 @@ class Server(object):
         return data
     # END REFERENCE: https://stackoverflow.com/questions/17667903/python-socket-receive-large-amount-of-data
 
+    def loadIndex(self):
+        self.storage.load()
+        # Compressed values start with the magic of their first block
+        magic = len(protocol.BLOCK_MAGIC)
+        self.compressed = set(key for key in self.storage.keys()
+                              if protocol.is_compressed(self.storage.read(key, 0, magic) or b''))
+        print('Indexed', self.storage.count(), 'keys,', len(self.compressed), 'compressed')
+
+    def lockFor(self, key):
+        return self.locks[hash(key) % len(self.locks)]
+
     def checkKey(self, key):
-        dirList = os.listdir(self.store)
-        return key in dirList
+        return self.storage.contains(key)
+
+    def cachedValue(self, key):
+        # Returns None for missing keys and for values too large to cache
+        if not self.checkKey(key):
+            return None
+        value = self.cache.get(key)
+        size = self.storage.size(key)
+        if value is not None or size is None or size > self.cache.maxItemBytes:
+            return value
+        with self.lockFor(key):
+            value = self.storage.read(key)
+            if value is not None:
+                self.cache.put(key, value)
+        return value
+
+    def readValue(self, key, offset=0, length=None):
+        value = self.cachedValue(key)
+        if value is None:
+            return self.storage.read(key, offset, length)
+        if offset == 0 and length is None:
+            return value
+        return value[offset:None if length is None else offset + length]
+
+    def plainValue(self, key, offset=0, length=None):
+        # Compressed values are decompressed for readers that did not ask
+        # for the blocks, and offsets then refer to the plain value
+        if key not in self.compressed:
+            return self.readValue(key, offset, length)
+        value = self.readValue(key)
+        if value is None:
+            return None
+        value = protocol.decompress_blocks(value)
+        return value[offset:None if length is None else offset + length]
+
+    def writeValue(self, key, value, compressed=False):
+        with self.lockFor(key):
+            self.storage.write(key, value)
+            self.cache.put(key, value)
+            if compressed:
+                self.compressed.add(key)
+            else:
+                self.compressed.discard(key)
+
+    def appendValue(self, key, value, compressed=False):
+        # A compressed record already carries its trailing newline. A value
+        # keeps the form it was created in, so records that arrive in the
+        # other form are converted first.
+        record = bytes(value) if compressed else bytes(value) + b'\n'
+        with self.lockFor(key):
+            if key in self.compressed:
+                if not compressed:
+                    record = protocol.compress_block(record, self.compressLevel)
+            elif compressed and self.storage.size(key):
+                record = protocol.decompress_blocks(record)
+            elif compressed:
+                self.compressed.add(key)
+            if self.storage.contains(key):
+                self.storage.append(key, record)
+                self.cache.extend(key, record)
+            else:
+                self.storage.append(key, record)
+                self.cache.put(key, record)
+
+    def deleteValue(self, key):
+        with self.lockFor(key):
+            deleted = self.storage.delete(key)
+            self.cache.remove(key)
+            self.compressed.discard(key)
+        return deleted
 
     def get(self, c, key):
-        if self.checkKey(key):
-            retrievedFile = open(os.path.join(self.store, key), 'r')
-            toSend = retrievedFile.read()
+        value = self.plainValue(key)
+        if value is not None:
+            toSend = value.decode('utf-8')
             message = 'VALUE ' + key + ' ' + str(len(toSend)) + ' \r\n'
             message = message + toSend + '\r\n' + ' END\r\n'
             self.send_msg(c, str.encode(message))
@@ -66,10 +168,7 @@ class Server(object):
             print('Size mismatch')
             return
         try:
-            outPath = os.path.join(self.store, key)
-            out = open(outPath, 'w+')
-            out.write(value)
-            out.close()
+            self.writeValue(key, value.encode('utf-8'))
             self.send_msg(c, b'STORED\r\n')
         except:
             print('Failed to write to fs')
@@ -85,15 +184,144 @@ class Server(object):
             print('Size mismatch')
             return
         try:
-            outPath = os.path.join(self.store, key)
-            out = open(outPath, 'a+')
-            out.write(value + '\n')
-            out.close()
+            self.appendValue(key, value.encode('utf-8'))
             self.send_msg(c, b'STORED\r\n')
         except:
             print('Failed to write to fs')
             self.send_msg(c, b'NOT-STORED\r\n')
 
+    def appendMany(self, c, key, value, count, size):
+        if len(value) != int(size) or value.count('\n') + 1 != int(count):
+            self.send_msg(c, b'NOT-STORED\r\n')
+            print('Size mismatch')
+            return
+        try:
+            self.appendValue(key, value.encode('utf-8'))
+            self.send_msg(c, b'STORED\r\n')
+        except:
+            print('Failed to write to fs')
+            self.send_msg(c, b'NOT-STORED\r\n')
+
+    def sendBinary(self, c, status, value=b'', flags=0):
+        c.sendall(protocol.pack_header(status, 0, len(value), flags))
+        if len(value) > 0:
+            c.sendall(value)
+
+    def getBinary(self, c, key, offset=0, length=None, flags=0):
+        if not self.checkKey(key):
+            self.sendBinary(c, protocol.NOT_FOUND)
+            return
+        responseFlags = 0
+        if key in self.compressed:
+            if not flags & protocol.ACCEPT_COMPRESSED:
+                value = self.plainValue(key, offset, length)
+                if value is None:
+                    self.sendBinary(c, protocol.NOT_FOUND)
+                else:
+                    self.sendBinary(c, protocol.OK, value)
+                return
+            responseFlags = protocol.COMPRESSED
+        value = self.cachedValue(key)
+        if value is not None:
+            offset = min(offset, len(value))
+            count = len(value) - offset if length is None else min(length, len(value) - offset)
+            self.sendBinary(c, protocol.OK, memoryview(value)[offset:offset + count], responseFlags)
+            return
+        path = self.storage.filePath(key)
+        if path is None:
+            value = self.storage.read(key, offset, length)
+            if value is None:
+                self.sendBinary(c, protocol.NOT_FOUND)
+            else:
+                self.sendBinary(c, protocol.OK, value, responseFlags)
+            return
+        try:
+            retrievedFile = open(path, 'rb')
+        except FileNotFoundError:
+            self.sendBinary(c, protocol.NOT_FOUND)
+            return
+        with retrievedFile:
+            size = os.fstat(retrievedFile.fileno()).st_size
+            offset = min(offset, size)
+            count = size - offset if length is None else min(length, size - offset)
+            c.sendall(protocol.pack_header(protocol.OK, 0, count, responseFlags))
+            if count > 0:
+                c.sendfile(retrievedFile, offset, count)
+
+    def sizeBinary(self, c, key, flags=0):
+        size = self.storage.size(key)
+        if size is None:
+            self.sendBinary(c, protocol.NOT_FOUND)
+            return
+        responseFlags = 0
+        if key in self.compressed:
+            if flags & protocol.ACCEPT_COMPRESSED:
+                responseFlags = protocol.COMPRESSED
+            else:
+                value = self.readValue(key)
+                if value is None:
+                    self.sendBinary(c, protocol.NOT_FOUND)
+                    return
+                size = protocol.raw_size(value)
+        self.sendBinary(c, protocol.OK, protocol.SIZE_VALUE.pack(size), responseFlags)
+
+    def stats(self):
+        stats = self.cache.stats()
+        stats['stored_keys'] = self.storage.count()
+        stats['compressed_keys'] = len(self.compressed)
+        stats.update(self.storage.stats())
+        return stats
+
+    def writeBinary(self, c, key, value, mode, flags=0):
+        compressed = flags & protocol.COMPRESSED != 0
+        try:
+            if mode == 'ab':
+                self.appendValue(key, value, compressed)
+            else:
+                self.writeValue(key, value, compressed)
+            self.sendBinary(c, protocol.OK)
+        except ValueError as e:
+            print('Bad compressed value:', e)
+            self.sendBinary(c, protocol.NOT_STORED)
+        except OSError:
+            print('Failed to write to fs')
+            self.sendBinary(c, protocol.NOT_STORED)
+
+    def binaryRequest(self, c):
+        header = protocol.recv_exactly(c, protocol.HEADER.size)
+        if header is None:
+            return False
+        opcode, flags, keyLength, valueLength = protocol.unpack_header(header)
+        key = protocol.recv_exactly(c, keyLength)
+        value = protocol.recv_exactly(c, valueLength)
+        if key is None or value is None:
+            return False
+        self.dispatchBinary(c, opcode, flags, key.decode('utf-8'), value)
+        return True
+
+    def dispatchBinary(self, c, opcode, flags, key, value):
+        if self.debug:
+            print('DEBUG:', opcode, key, len(value))
+        if opcode == protocol.GET:
+            self.getBinary(c, key, flags=flags)
+        elif opcode == protocol.GETRANGE:
+            offset, length = protocol.RANGE.unpack(value)
+            self.getBinary(c, key, offset, length, flags)
+        elif opcode == protocol.SIZE:
+            self.sizeBinary(c, key, flags)
+        elif opcode == protocol.STATS:
+            self.sendBinary(c, protocol.OK, json.dumps(self.stats()).encode('utf-8'))
+        elif opcode == protocol.SET:
+            self.writeBinary(c, key, value, 'wb', flags)
+        elif opcode == protocol.APPEND or opcode == protocol.MAPPEND:
+            self.writeBinary(c, key, value, 'ab', flags)
+        elif opcode == protocol.DELETE:
+            self.sendBinary(c, protocol.OK if self.deleteValue(key) else protocol.NOT_FOUND)
+        elif opcode == protocol.FEATURES:
+            self.sendBinary(c, protocol.OK, flags=flags & protocol.COMPRESSED)
+        else:
+            self.sendBinary(c, protocol.ERROR)
+
     def parseMessage(self, message):
         parsedMessage = message.decode('utf-8')
         parsedMessage = parsedMessage.split('\r\n')
@@ -120,8 +348,15 @@ class Server(object):
         return True
 
     def connectionThread(self, connection):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        binary = False
         while True:
             try:
+                if binary:
+                    if not self.binaryRequest(connection):
+                        connection.close()
+                        break
+                    continue
                 rawMessage = self.recv_msg(connection)
                 if self.debug:
                     print('DEBUG:', rawMessage)
@@ -129,24 +364,43 @@ class Server(object):
                     if connection:
                         connection.close()
                         break
-                parsedMessage = self.parseMessage(rawMessage)
-                if self.validateMessage(parsedMessage):
-                    if parsedMessage[0] == "set":
-                        self.set(
-                            connection, parsedMessage[1], parsedMessage[4], parsedMessage[2])
-                    elif parsedMessage[0] == "get":
-                        self.get(connection, parsedMessage[1])
-                    elif parsedMessage[0] == "append":
-                        self.append(
-                            connection, parsedMessage[1], parsedMessage[4], parsedMessage[2])
+                if rawMessage == protocol.HELLO:
+                    self.send_msg(connection, protocol.HELLO_OK)
+                    binary = True
+                    continue
+                self.dispatchText(connection, rawMessage)
             except KeyboardInterrupt:
                 if connection:
                     connection.close()
                 break
-            except:
-                pass
+            except (ValueError, IndexError) as e:
+                if binary:
+                    # A broken binary frame leaves the stream out of sync
+                    connection.close()
+                    break
+                print('Bad request:', e)
+            except Exception as e:
+                # Retrying a broken connection would spin forever
+                print('Closing connection:', e)
+                connection.close()
+                break
         return
 
+    def dispatchText(self, c, rawMessage):
+        parsedMessage = self.parseMessage(rawMessage)
+        if self.validateMessage(parsedMessage):
+            if parsedMessage[0] == "set":
+                self.set(
+                    c, parsedMessage[1], parsedMessage[4], parsedMessage[2])
+            elif parsedMessage[0] == "get":
+                self.get(c, parsedMessage[1])
+            elif parsedMessage[0] == "append":
+                self.append(
+                    c, parsedMessage[1], parsedMessage[4], parsedMessage[2])
+            elif parsedMessage[0] == "mappend":
+                self.appendMany(
+                    c, parsedMessage[1], parsedMessage[5], parsedMessage[2], parsedMessage[3])
+
     def check_store(self):
         return 'store' in os.listdir(os.getcwd())
 
@@ -159,30 +413,66 @@ class Server(object):
             print('Something went wrong when initializing the store.')
         return False
 
-    def run(self):
+    def prepare(self):
         if not self.check_store():
             print('Store not found')
             if not self.create_store():
                 sys.exit()
+        self.loadIndex()
 
-        self.socket.listen(5)
-        print("Socket is listening at", self.networkConfig)
-        while True:
-            connection, addr = self.socket.accept()
-            print('Got connection from', addr)
-            # Start a connection thread here
-            t = threading.Thread(
-                target=self.connectionThread, args=(connection,))
-            t.start()
-        connection.close()
+    def handleSignals(self):
+        # SIGTERM, e.g. when the VM shuts down, leaves run through the same
+        # cleanup as Ctrl-C, so buffered writes reach the disk
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    def close(self):
+        self.storage.close()
         self.socket.close()
         print('Bye')
 
+    def run(self):
+        self.prepare()
+        self.handleSignals()
+
+        self.socket.listen(self.backlog)
+        print("Socket is listening at", self.networkConfig)
+        try:
+            while True:
+                connection, addr = self.socket.accept()
+                print('Got connection from', addr)
+                # Start a connection thread here
+                t = threading.Thread(
+                    target=self.connectionThread, args=(connection,), daemon=True)
+                t.start()
+        finally:
+            self.close()
+
     def greet(self):
         print('Server')
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=80)
+    parser.add_argument('--cache-mb', type=int, default=64, help='memory limit of the value cache')
+    parser.add_argument('--max-item-mb', type=int, default=None, help='largest value kept in the cache')
+    parser.add_argument('--mode', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('--io-threads', type=int, default=8, help='disk I/O threads in async mode')
+    parser.add_argument('--backlog', type=int, default=128)
+    parser.add_argument('--storage', choices=['file', 'log'], default='file')
+    args = parser.parse_args()
 
-    server = Server(debug=True)
+    options = {
+        'debug': True,
+        'cacheBytes': args.cache_mb * 1024 * 1024,
+        'maxItemBytes': None if args.max_item_mb is None else args.max_item_mb * 1024 * 1024,
+        'backlog': args.backlog,
+        'storage': args.storage,
+    }
+    if args.mode == 'async':
+        from AsyncServer import AsyncServer
+        server = AsyncServer(('', args.port), ioThreads=args.io_threads, **options)
+    else:
+        server = Server(('', args.port), **options)
     server.run()
@@ -0,0 +1,80 @@
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    # Values are kept as lists of chunks so appends never copy the cached
+    # value. The chunks are joined lazily on the next read.
+    def __init__(self, maxBytes=64 * 1024 * 1024, maxItemBytes=None):
+        self.maxBytes = maxBytes
+        self.maxItemBytes = maxItemBytes if maxItemBytes is not None else maxBytes // 4
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+            chunks = entry[0]
+            if len(chunks) > 1:
+                chunks[:] = [b''.join(chunks)]
+            return chunks[0]
+
+    def put(self, key, value):
+        with self.lock:
+            self.discard(key)
+            if len(value) > self.maxItemBytes:
+                return False
+            self.entries[key] = [[bytes(value)], len(value)]
+            self.size += len(value)
+            self.evict()
+            return True
+
+    def extend(self, key, value):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            if entry[1] + len(value) > self.maxItemBytes:
+                self.discard(key)
+                return False
+            entry[0].append(bytes(value))
+            entry[1] += len(value)
+            self.size += len(value)
+            self.entries.move_to_end(key)
+            self.evict()
+            return True
+
+    def discard(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def remove(self, key):
+        with self.lock:
+            self.discard(key)
+
+    def evict(self):
+        while self.size > self.maxBytes and len(self.entries) > 0:
+            key, entry = self.entries.popitem(last=False)
+            self.size -= entry[1]
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'keys': len(self.entries),
+                'bytes': self.size,
+                'max_bytes': self.maxBytes,
+            }
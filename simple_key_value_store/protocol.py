@@ -0,0 +1,131 @@
+import struct
+import zlib
+
+# Binary framing negotiated with a text "hello binary" request. Every binary
+# request is HEADER + key + value and every response is HEADER + value, where
+# the response opcode carries the status.
+MAGIC = b'KV'
+HEADER = struct.Struct('>2sBBHQ')
+RANGE = struct.Struct('>QQ')
+SIZE_VALUE = struct.Struct('>Q')
+HELLO = b'hello binary \r\n'
+HELLO_OK = b'BINARY\r\n'
+
+GET = 1
+SET = 2
+APPEND = 3
+MAPPEND = 4
+GETRANGE = 5
+SIZE = 6
+STATS = 7
+DELETE = 8
+FEATURES = 9
+
+OK = 0
+NOT_FOUND = 1
+NOT_STORED = 2
+ERROR = 3
+
+# Flags. On a write, COMPRESSED says the value is a sequence of compressed
+# blocks. On a read, ACCEPT_COMPRESSED lets the server answer with the
+# blocks as stored, and the response carries COMPRESSED when it did.
+# FEATURES requests the features in its flags and the response grants the
+# ones the server supports.
+COMPRESSED = 1
+ACCEPT_COMPRESSED = 2
+
+# A compressed value is stored as a run of blocks: BLOCK header (magic,
+# compressed length, raw length) followed by zlib data. Appending a block
+# appends its records, so compressed values can still grow by appends.
+BLOCK_MAGIC = b'\x00KZ\x01'
+BLOCK = struct.Struct('>4sII')
+
+
+def pack_header(opcode, key_length, value_length, flags=0):
+    return HEADER.pack(MAGIC, opcode, flags, key_length, value_length)
+
+
+def unpack_header(header):
+    magic, opcode, flags, key_length, value_length = HEADER.unpack(header)
+    if magic != MAGIC:
+        raise ValueError('Bad frame magic')
+    return opcode, flags, key_length, value_length
+
+
+def recv_into(sock, buffer):
+    # Fill a preallocated buffer straight from the socket
+    view = memoryview(buffer)
+    received = 0
+    while received < len(buffer):
+        n = sock.recv_into(view[received:])
+        if n == 0:
+            return None
+        received += n
+    return buffer
+
+
+def recv_exactly(sock, n):
+    return recv_into(sock, bytearray(n))
+
+
+def to_bytes(value):
+    if isinstance(value, str):
+        return value.encode('utf-8')
+    return value
+
+
+def compress_block(data, level):
+    compressed = zlib.compress(data, level)
+    return BLOCK.pack(BLOCK_MAGIC, len(compressed), len(data)) + compressed
+
+
+def is_compressed(data):
+    return bytes(data[:len(BLOCK_MAGIC)]) == BLOCK_MAGIC
+
+
+class BlockDecoder(object):
+    # Decompresses a run of blocks that arrives in arbitrary chunks, e.g.
+    # range reads of a compressed value
+    def __init__(self):
+        self.pending = bytearray()
+
+    def feed(self, chunk):
+        self.pending.extend(chunk)
+        parts = []
+        position = 0
+        while position + BLOCK.size <= len(self.pending):
+            magic, length, rawLength = BLOCK.unpack_from(self.pending, position)
+            if magic != BLOCK_MAGIC:
+                raise ValueError('Bad block magic')
+            end = position + BLOCK.size + length
+            if end > len(self.pending):
+                break
+            try:
+                parts.append(zlib.decompress(self.pending[position + BLOCK.size:end]))
+            except zlib.error as e:
+                raise ValueError('Bad compressed block: ' + str(e))
+            position = end
+        del self.pending[:position]
+        return b''.join(parts)
+
+    def close(self):
+        if len(self.pending) > 0:
+            raise ValueError('Truncated compressed block')
+
+
+def decompress_blocks(data):
+    decoder = BlockDecoder()
+    value = decoder.feed(data)
+    decoder.close()
+    return value
+
+
+def raw_size(data):
+    # Size of a run of blocks once decompressed, read from the block headers
+    size = 0
+    position = 0
+    while position + BLOCK.size <= len(data):
+        magic, length, rawLength = BLOCK.unpack_from(data, position)
+        size += rawLength
+        position += BLOCK.size + length
+    return size
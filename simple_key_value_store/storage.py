@@ -0,0 +1,328 @@
+import os
+import struct
+import threading
+import time
+
+
+class FileStorage(object):
+    # One file per key, the original layout of the store
+    def __init__(self, path):
+        self.path = path
+        self.index = {}
+
+    def load(self):
+        self.index = {}
+        for key in os.listdir(self.path):
+            keyPath = os.path.join(self.path, key)
+            if os.path.isfile(keyPath):
+                self.index[key] = os.path.getsize(keyPath)
+
+    def contains(self, key):
+        return key in self.index
+
+    def size(self, key):
+        return self.index.get(key)
+
+    def count(self):
+        return len(self.index)
+
+    def keys(self):
+        return list(self.index)
+
+    def filePath(self, key):
+        return os.path.join(self.path, key)
+
+    def read(self, key, offset=0, length=None):
+        try:
+            with open(self.filePath(key), 'rb') as retrievedFile:
+                retrievedFile.seek(offset)
+                return retrievedFile.read(-1 if length is None else length)
+        except FileNotFoundError:
+            self.index.pop(key, None)
+            return None
+
+    def write(self, key, value):
+        with open(self.filePath(key), 'wb') as out:
+            out.write(value)
+        self.index[key] = len(value)
+
+    def append(self, key, value):
+        with open(self.filePath(key), 'ab') as out:
+            out.write(value)
+        self.index[key] = self.index.get(key, 0) + len(value)
+
+    def delete(self, key):
+        try:
+            os.remove(self.filePath(key))
+        except FileNotFoundError:
+            pass
+        return self.index.pop(key, None) is not None
+
+    def stats(self):
+        return {'storage': 'file'}
+
+    def close(self):
+        pass
+
+
+class LogStorage(object):
+    # Every write is a record appended to the active segment:
+    # RECORD header (kind, key length, value length), key, value.
+    # The index maps each key to the extents that make up its value.
+    RECORD = struct.Struct('>BHQ')
+    SET = 1
+    APPEND = 2
+    DELETE = 3
+
+    def __init__(self, path, segmentBytes=64 * 1024 * 1024, flushBytes=1024 * 1024, compactInterval=60,
+                 compactRatio=0.5):
+        self.path = path
+        self.segmentBytes = segmentBytes
+        self.flushBytes = flushBytes
+        self.compactInterval = compactInterval
+        self.compactRatio = compactRatio
+        self.index = {}
+        self.segments = {}
+        self.retired = []
+        self.liveBytes = 0
+        self.deadBytes = 0
+        self.active = None
+        self.activeId = -1
+        self.position = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.compactions = 0
+        self.lock = threading.RLock()
+        # Writers waiting for their records to be flushed queue up here
+        self.flushLock = threading.Lock()
+        self.compactLock = threading.Lock()
+        self.closed = False
+
+    def segmentPath(self, segmentId):
+        return os.path.join(self.path, 'segment_%08d.log' % segmentId)
+
+    def load(self):
+        os.makedirs(self.path, exist_ok=True)
+        for name in os.listdir(self.path):
+            if name.endswith('.tmp'):
+                # Left by a compaction that did not finish
+                os.remove(os.path.join(self.path, name))
+        segmentIds = sorted(
+            int(name[len('segment_'):-len('.log')])
+            for name in os.listdir(self.path) if name.startswith('segment_') and name.endswith('.log'))
+        for segmentId in segmentIds:
+            self.replay(segmentId)
+        self.openSegment(segmentIds[-1] + 1 if len(segmentIds) > 0 else 0)
+        threading.Thread(target=self.compactThread, daemon=True).start()
+
+    def replay(self, segmentId):
+        path = self.segmentPath(segmentId)
+        with open(path, 'rb') as segment:
+            data = segment.read()
+        position = 0
+        while position + self.RECORD.size <= len(data):
+            kind, keyLength, valueLength = self.RECORD.unpack_from(data, position)
+            keyStart = position + self.RECORD.size
+            end = keyStart + keyLength + valueLength
+            if end > len(data):
+                break
+            key = data[keyStart:keyStart + keyLength].decode('utf-8')
+            self.apply(kind, key, segmentId, keyStart + keyLength, valueLength)
+            position = end
+        if position < len(data):
+            print('Dropping torn record at the end of', path)
+            os.truncate(path, position)
+        self.segments[segmentId] = os.open(path, os.O_RDONLY)
+
+    def apply(self, kind, key, segmentId, offset, length):
+        entry = self.index.get(key)
+        if kind == self.DELETE:
+            if entry is not None:
+                del self.index[key]
+                self.liveBytes -= entry[0]
+                self.deadBytes += entry[0]
+            return
+        if kind == self.SET or entry is None:
+            if entry is not None:
+                self.liveBytes -= entry[0]
+                self.deadBytes += entry[0]
+            entry = [0, []]
+            self.index[key] = entry
+        entry[1].append((segmentId, offset, length))
+        entry[0] += length
+        self.liveBytes += length
+
+    def openSegment(self, segmentId):
+        path = self.segmentPath(segmentId)
+        self.active = open(path, 'ab', buffering=self.flushBytes)
+        self.activeId = segmentId
+        self.position = self.active.tell()
+        self.flushed = self.position
+        self.segments[segmentId] = os.open(path, os.O_RDONLY)
+
+    def rollSegment(self, skip=0):
+        # skip leaves segment ids free for compaction to fill in
+        self.flush()
+        self.active.close()
+        self.openSegment(self.activeId + 1 + skip)
+
+    def writeRecord(self, kind, key, value):
+        keyBytes = key.encode('utf-8')
+        with self.lock:
+            if self.position >= self.segmentBytes:
+                self.rollSegment()
+            self.active.write(self.RECORD.pack(kind, len(keyBytes), len(value)))
+            self.active.write(keyBytes)
+            self.active.write(value)
+            offset = self.position + self.RECORD.size + len(keyBytes)
+            self.position = offset + len(value)
+            self.apply(kind, key, self.activeId, offset, len(value))
+            return self.activeId, self.position
+
+    def commit(self, segmentId, position):
+        # Returns once the record ending at position is out of the user-space
+        # buffer, so a write is only acknowledged after it reached the OS.
+        # Group commit: writers that queued up behind a flush find their
+        # records already written by it. Must not be called with the lock
+        # held.
+        with self.flushLock:
+            with self.lock:
+                if segmentId == self.activeId and position > self.flushed:
+                    self.flush()
+
+    def flush(self):
+        with self.lock:
+            if self.position > self.flushed:
+                self.active.flush()
+                self.flushed = self.position
+                self.flushes += 1
+
+    def contains(self, key):
+        return key in self.index
+
+    def size(self, key):
+        entry = self.index.get(key)
+        return None if entry is None else entry[0]
+
+    def count(self):
+        return len(self.index)
+
+    def keys(self):
+        return list(self.index)
+
+    def filePath(self, key):
+        return None
+
+    def read(self, key, offset=0, length=None):
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            size = entry[0]
+            extents = [(self.segments[segmentId], extentOffset, extentLength)
+                       for segmentId, extentOffset, extentLength in entry[1]]
+            # A writer may not have committed its record yet
+            last = entry[1][-1]
+            if last[0] == self.activeId and last[1] + last[2] > self.flushed:
+                self.flush()
+        end = size if length is None else min(size, offset + length)
+        parts = []
+        start = 0
+        for fd, extentOffset, extentLength in extents:
+            if start >= end:
+                break
+            if start + extentLength > offset:
+                skip = max(0, offset - start)
+                count = min(extentLength, end - start) - skip
+                parts.append(os.pread(fd, count, extentOffset + skip))
+            start += extentLength
+        return b''.join(parts)
+
+    def write(self, key, value):
+        self.commit(*self.writeRecord(self.SET, key, value))
+
+    def append(self, key, value):
+        self.commit(*self.writeRecord(self.APPEND, key, value))
+
+    def delete(self, key):
+        # A DELETE record keeps the key gone when the segments are replayed
+        with self.lock:
+            if key not in self.index:
+                return False
+            written = self.writeRecord(self.DELETE, key, b'')
+        self.commit(*written)
+        return True
+
+    def compact(self):
+        # Rewrites every live value as a single SET record in a fresh segment
+        # and drops the old ones. The new segment is built without holding
+        # the lock, under an id between the old segments and the active one,
+        # so writes made in the meantime still replay after it. Keys that
+        # were set or deleted in the meantime keep their new value. Old read
+        # descriptors are closed one cycle later so reads that already
+        # looked up their extents still work.
+        with self.compactLock:
+            with self.lock:
+                for fd in self.retired:
+                    os.close(fd)
+                self.retired = []
+                self.rollSegment(skip=1)
+                segmentId = self.activeId - 1
+                old = [oldId for oldId in self.segments if oldId < segmentId]
+                fds = dict(self.segments)
+                deadBytes = self.deadBytes
+                snapshot = [(key, entry, list(entry[1])) for key, entry in self.index.items()]
+            path = self.segmentPath(segmentId)
+            moved = []
+            position = 0
+            with open(path + '.tmp', 'wb', buffering=self.flushBytes) as out:
+                for key, entry, extents in snapshot:
+                    keyBytes = key.encode('utf-8')
+                    value = b''.join(os.pread(fds[extentSegment], extentLength, extentOffset)
+                                     for extentSegment, extentOffset, extentLength in extents)
+                    out.write(self.RECORD.pack(self.SET, len(keyBytes), len(value)))
+                    out.write(keyBytes)
+                    out.write(value)
+                    offset = position + self.RECORD.size + len(keyBytes)
+                    position = offset + len(value)
+                    moved.append((key, entry, extents, (segmentId, offset, len(value))))
+                out.flush()
+                os.fsync(out.fileno())
+            os.rename(path + '.tmp', path)
+            with self.lock:
+                self.segments[segmentId] = os.open(path, os.O_RDONLY)
+                for key, entry, extents, extent in moved:
+                    # Appends made in the meantime stay as extents after it
+                    if self.index.get(key) is entry and entry[1][:len(extents)] == extents:
+                        entry[1][:len(extents)] = [extent]
+                for oldId in old:
+                    self.retired.append(self.segments.pop(oldId))
+                    os.remove(self.segmentPath(oldId))
+                # Only values replaced while the segment was built are dead
+                self.deadBytes -= deadBytes
+                self.compactions += 1
+
+    def compactThread(self):
+        while not self.closed:
+            time.sleep(self.compactInterval)
+            if self.deadBytes > self.compactRatio * (self.liveBytes + self.deadBytes):
+                print('Compacting log storage')
+                self.compact()
+
+    def stats(self):
+        return {
+            'storage': 'log',
+            'segments': len(self.segments),
+            'live_bytes': self.liveBytes,
+            'dead_bytes': self.deadBytes,
+            'flushes': self.flushes,
+            'compactions': self.compactions,
+        }
+
+    def close(self):
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.flush()
+            self.active.close()
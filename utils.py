@@ -1,14 +1,66 @@
 import hashlib
 import os
+import re
 import sys
+
+WHITESPACE = re.compile(rb'\s')
+
 def hash_function(key, mod):
     return int(hashlib.sha1(key.encode('utf-8')).hexdigest(), 16) % (mod if mod > 0 else 1)
 
+def intermediate_key(map_id, reduce_id, attempt):
+    # Every map attempt writes its own M x R pieces, so retries and
+    # duplicates never touch the output of another attempt.
+    return 'intermediate_' + str(map_id) + '_' + str(reduce_id) + '_' + str(attempt)
+
+def commit_key(map_id):
+    # Holds the attempt of map_id that the master committed
+    return 'map_commit_' + str(map_id)
+
+def output_key(output, reduce_id, attempt):
+    return output + '_' + str(reduce_id) + '_' + str(attempt)
+
+def parse_record(t):
+    try:
+        k,v = t.split(':')
+        return (k,v)
+    except ValueError:
+        return None
+
+def parse_records(data):
+    tuple_data = []
+    for t in data.split('\n'):
+        record = parse_record(t)
+        if record is not None:
+            tuple_data.append(record)
+    return tuple_data
+
+def split_offsets(size, n, read_window, window=4096):
+    # Move every cut forward to the next whitespace byte so no word is split.
+    # Whitespace is ASCII, so this never lands inside a UTF-8 sequence either.
+    offsets = [0]
+    for i in range(1, n):
+        offset = max(size * i // n, offsets[-1])
+        while offset < size:
+            chunk = read_window(offset, window)
+            if not chunk:
+                offset = size
+                break
+            match = WHITESPACE.search(chunk)
+            if match is not None:
+                offset += match.start()
+                break
+            offset += len(chunk)
+        offsets.append(min(offset, size))
+    offsets.append(size)
+    return [(offsets[i], offsets[i + 1]) for i in range(n)]
+
 def clear_store():
     files = [
         'intermediate',
         'split',
-        'output'
+        'output',
+        'map_commit'
     ]
     curr_dir = os.getcwd()
     store_path = os.path.join(curr_dir, 'simple_key_value_store', 'store')
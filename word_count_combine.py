@@ -0,0 +1,5 @@
+def combine_fn(key, values):
+    total = 0
+    for v in values:
+        total += int(v)
+    return total
@@ -1,8 +1,5 @@
-def reduce_fn(tuple_data):
-    D = {}
-    for k, v in tuple_data:
-        if k not in D:
-            D[k] = 1
-        else:
-            D[k] += 1
-    return tuple(list(zip(D.keys(), D.values())))
+def reduce_fn(key, values):
+    total = 0
+    for v in values:
+        total += int(v)
+    return total